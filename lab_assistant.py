@@ -6,8 +6,33 @@ import os
 import zipfile
 import time
 import re
+import hashlib
+import json
+import zlib
+import queue
+import tempfile
+import threading
+import uuid
+import sqlite3
+import difflib
+from collections import defaultdict, deque
+import numpy as np
 from docx import Document
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from pypdf import PdfReader  # optional: PDF text for near-duplicate detection
+except ImportError:
+    PdfReader = None
+try:
+    from PIL import Image  # optional: image dimensions for pre-flight token estimates
+except ImportError:
+    Image = None
+try:
+    import fcntl  # POSIX file locks for the shared autosave folder
+except ImportError:
+    fcntl = None
 
 # --- 1. PAGE SETUP (MUST BE FIRST) ---
 st.set_page_config(
@@ -26,6 +51,57 @@ else:
     st.info("On Streamlit Cloud, add your key to the 'Secrets' settings.")
     st.stop()
 
+# Grading capacity is shared by every teacher on this deployment (one API key, one rate limit)
+MAX_CONCURRENT_GRADES = int(os.environ.get("GRADER_MAX_CONCURRENCY", 4))
+GRADE_DISPATCH_INTERVAL = float(os.environ.get("GRADER_DISPATCH_INTERVAL", 1.0))  # seconds between API calls
+INTERACTIVE_BATCH_SIZE = 5  # batches this small jump ahead of bulk uploads
+GRADE_RETRY_SWEEPS = 1  # automatic end-of-batch retries of transient failures before they are dead-lettered
+BATCH_ABANDON_SECONDS = 90  # queued jobs of a batch no open page has followed for this long are dropped
+
+# Near-duplicate detection (MinHash signatures + LSH banding)
+DUPLICATE_SIMILARITY_THRESHOLD = 0.8  # estimated Jaccard similarity of 5-word shingles
+
+# Upload-once mode: PDFs/photos go to the Files API once and are referenced by ID afterwards
+FILES_API_BETA = "files-api-2025-04-14"
+FILES_API_BASE_URL = os.environ.get("GRADER_FILES_API_BASE_URL", "")  # "" = Anthropic API, "local" = offline stand-in
+
+# Per-request deadlines and hedging, derived from observed grading latency
+GRADE_DEFAULT_DEADLINE = float(os.environ.get("GRADER_DEFAULT_DEADLINE", 300))  # seconds, until enough latencies are seen
+GRADE_MIN_DEADLINE = 60.0  # never cut a request off sooner than this
+GRADE_DEADLINE_MULTIPLIER = 2.0  # deadline = multiplier x observed p99
+HEDGE_BUDGET = float(os.environ.get("GRADER_HEDGE_BUDGET", 0.1))  # max share of requests that may get a hedged duplicate
+LATENCY_MIN_SAMPLES = 20  # no hedging until this many requests have completed
+
+# Pre-flight planner: request limits and estimates shown before a batch is queued
+GRADE_MAX_TOKENS = 4096
+MAX_REQUEST_BYTES = 32 * 1024 * 1024  # API request size limit (base64 inflates files by 4/3)
+MAX_UPLOAD_BYTES = 500 * 1024 * 1024  # Files API per-file limit, for reports sent by reference
+MAX_PDF_PAGES = 100
+MAX_IMAGE_BYTES = 5 * 1024 * 1024
+MAX_IMAGE_EDGE = 8000  # pixels
+OUTPUT_TOKENS_ESTIMATE = 2500  # typical feedback length; local scoring replies run shorter
+DEFAULT_GRADE_SECONDS = 60.0  # per-report latency assumed until real latencies are observed
+# USD per million (input, output) tokens; the first pattern found in the model ID wins
+MODEL_PRICING = [
+    ("claude-opus-4-1", 15.0, 75.0), ("claude-opus-4-2025", 15.0, 75.0), ("claude-3-opus", 15.0, 75.0),
+    ("opus", 5.0, 25.0), ("sonnet", 3.0, 15.0), ("haiku", 1.0, 5.0),
+]
+
+# Record/replay of grading calls ("live" calls the API; "replay" answers from recordings, for offline regression runs)
+API_MODE = os.environ.get("GRADER_API_MODE", "live")
+RECORD_CALLS = os.environ.get("GRADER_RECORD_CALLS", "1") == "1"
+
+# Photo submissions: one student's page photos go in a single request
+MAX_PHOTO_PAGES = 20
+PHOTO_REQUEST_BUDGET = 20 * 1024 * 1024  # base64 bytes for all pages together
+PHOTO_BUDGET_STEPS = [(1568, 85), (1280, 75), (1024, 65), (800, 55)]  # (long edge px, JPEG quality), tried in order
+
+# Exports (.docx master + .zip bundle)
+EXPORT_SPOOL_BYTES = 32 * 1024 * 1024  # each export stays in RAM up to this size, then spills to a temp file
+
+# Feedback search: whose history a session searches when nobody is signed in (one teacher per deployment by default)
+TEACHER_ID = os.environ.get("GRADER_TEACHER_ID", "deployment")
+
 # --- 3. HARDCODED RUBRIC ---
 PRE_IB_RUBRIC = """TOTAL: 100 POINTS (10 pts per section)
 
@@ -113,6 +189,67 @@ PRE_IB_RUBRIC = """TOTAL: 100 POINTS (10 pts per section)
 - FORMATTING: Do NOT deduct for minor formatting/APA errors.
 """
 
+# Machine-readable form of PRE_IB_RUBRIC for local scoring: code -> (section, description, points, group).
+# Codes sharing a group are alternatives (only the largest applies). REFERENCES uses a ladder of
+# levels that set the score instead of deducting from it.
+DEDUCTION_RULES = {
+    "FMT-SUB-1": ("FORMATTING", "1-2 subscript/superscript errors", 0.5, "subscripts"),
+    "FMT-SUB-3": ("FORMATTING", "3+ subscript/superscript errors", 1.0, "subscripts"),
+    "INT-OBJ-MISSING": ("INTRODUCTION", "Objective missing", 1.0, "objective"),
+    "INT-OBJ-VAGUE": ("INTRODUCTION", "Objective vague or implicit", 0.5, "objective"),
+    "INT-EQN-MISSING": ("INTRODUCTION", "Balanced chemical equation missing", 1.0, None),
+    "INT-THEORY-MISSING": ("INTRODUCTION", "Background theory missing or irrelevant", 3.0, "theory"),
+    "INT-THEORY-WEAK": ("INTRODUCTION", "Background theory brief, weak or superficially connected", 2.0, "theory"),
+    "HYP-JUST-MISSING": ("HYPOTHESIS", "Scientific justification missing", 2.0, "justification"),
+    "HYP-JUST-VAGUE": ("HYPOTHESIS", "Justification incomplete or vague", 1.0, "justification"),
+    "HYP-UNITS-MISSING": ("HYPOTHESIS", "Units for IV and DV missing", 1.0, "units"),
+    "HYP-UNITS-PARTIAL": ("HYPOTHESIS", "Units for IV/DV incomplete", 0.5, "units"),
+    "HYP-MEAS-MISSING": ("HYPOTHESIS", "DV measurement description missing", 1.0, "measurement"),
+    "HYP-MEAS-VAGUE": ("HYPOTHESIS", "DV measurement description vague", 0.5, "measurement"),
+    "VAR-WRONG-ID": ("VARIABLES", "IV/DV swapped or wrong variable listed", 1.0, None),
+    "VAR-DV-VAGUE": ("VARIABLES", "DV measurement vague", 0.5, None),
+    "VAR-JUST-MISSING": ("VARIABLES", "Explanations/justifications missing", 1.0, "justification"),
+    "VAR-CTRL-JUST-VAGUE": ("VARIABLES", "Justification of control variables vague", 0.5, "justification"),
+    "VAR-CTRL-MISSING": ("VARIABLES", "Control variables missing", 4.0, "controls"),
+    "VAR-CTRL-INVALID": ("VARIABLES", "Control variables attempted but incorrect", 2.0, "controls"),
+    "VAR-CTRL-ONLY-2": ("VARIABLES", "Only 2 control variables given", 2.0, "controls"),
+    "VAR-IV-MISSING": ("VARIABLES", "Independent variable missing", 2.0, None),
+    "VAR-DV-MISSING": ("VARIABLES", "Dependent variable missing", 2.0, None),
+    "PRO-DIAGRAM-MISSING": ("PROCEDURES", "Diagram/photo of experimental setup missing", 0.5, None),
+    "DA-EQN-MISSING": ("DATA ANALYSIS", "Trendline equation not shown on graph", 1.0, None),
+    "DA-R2-MISSING": ("DATA ANALYSIS", "R² value not shown on graph", 1.0, None),
+    "DA-CALC-UNCLEAR": ("DATA ANALYSIS", "Calculations unclear", 1.0, None),
+    "DA-STEPS-UNLABELED": ("DATA ANALYSIS", "Calculation steps not explained or labeled", 0.5, None),
+    "CON-HYP-MISSING": ("CONCLUSION", "Hypothesis support not stated", 1.0, None),
+    "CON-OUTLIER-MISSING": ("CONCLUSION", "Outliers/omissions not mentioned", 1.0, "outliers"),
+    "CON-OUTLIER-VAGUE": ("CONCLUSION", "Outliers/omissions mentioned vaguely", 0.5, "outliers"),
+    "CON-TREND-POOR": ("CONCLUSION", "IV/DV relationship poorly explained", 1.0, None),
+    "CON-THEORY-MISSING": ("CONCLUSION", "No connection to chemical theory", 1.0, None),
+    "CON-QUANT-MISSING": ("CONCLUSION", "No specific numbers cited", 2.0, None),
+    "CON-QUAL-MISSING": ("CONCLUSION", "No observations cited", 0.5, None),
+    "CON-LIT-VAGUE": ("CONCLUSION", "Literature comparison vague (no values)", 0.5, None),
+    "CON-R-MISSING": ("CONCLUSION", "R value not listed", 1.0, "r"),
+    "CON-R-VAGUE": ("CONCLUSION", "R explanation vague or confused with R²", 0.5, "r"),
+    "CON-R2-MISSING": ("CONCLUSION", "R² explanation missing", 1.0, "r2"),
+    "CON-R2-VAGUE": ("CONCLUSION", "R² explanation vague", 0.5, "r2"),
+    "CON-REPETITIVE": ("CONCLUSION", "Repetitive or unfocused", 0.5, None),
+    "EVA-CLASS-MISSING": ("EVALUATION", "Neither 'systematic' nor 'random' used", 0.5, None),
+    "EVA-IMPACT-NONE": ("EVALUATION", "No errors have a directional impact", 2.0, "impact"),
+    "EVA-IMPACT-PARTIAL": ("EVALUATION", "Some errors lack a directional impact", 1.0, "impact"),
+    "EVA-IMPROVE-GENERIC": ("EVALUATION", "Improvements generic ('be careful')", 2.0, "improvements"),
+    "EVA-IMPROVE-VAGUE": ("EVALUATION", "Improvements vague (no specific equipment)", 0.5, "improvements"),
+    "REF-APA-MAJOR": ("REFERENCES", "Major APA formatting errors", 0.5, None),
+}
+REFERENCE_LEVELS = {
+    "REF-3": (10.0, "3+ credible references"),
+    "REF-2": (7.0, "2 credible references"),
+    "REF-1": (5.0, "1 credible reference"),
+    "REF-ATTEMPTED": (4.0, "Section present, no credible sources"),
+    "REF-NONE": (0.0, "References section missing"),
+}
+REFERENCES_FLOOR = 4.0  # minimum whenever the section exists
+OTHER_DEDUCTION_MAX = 2.0  # "<SECTION>-OTHER=x" covers criteria without a listed value (e.g. Raw Data)
+
 # --- 4. SYSTEM PROMPT ---
 SYSTEM_PROMPT = """You are an expert Pre-IB Chemistry Lab Grader. 
 Your goal is to grade student lab reports according to the specific rules below.
@@ -331,14 +468,18 @@ STUDENT: [Filename]
 """
 
 # --- 5. SESSION STATE INITIALIZATION ---
+AUTOSAVE_ROOT = os.path.join(os.getcwd(), "autosave_feedback_pre-ib")
+
+if 'user_id' not in st.session_state:
+    st.session_state.user_id = uuid.uuid4().hex
+
 if 'autosave_dir' not in st.session_state:
-    # 1. Initialize Autosave Folder (The Fix from before)
-    base_folder = "autosave_feedback_pre-ib"
-    current_dir = os.getcwd()
-    full_path = os.path.join(current_dir, base_folder)
+    # 1. Initialize Autosave Folder: one subfolder per browser session, so concurrent
+    # graders (and replicas sharing the same storage) never write into each other's gradebook
+    full_path = os.path.join(AUTOSAVE_ROOT, "sessions", f"{time.strftime('%Y%m%d-%H%M%S')}_{st.session_state.user_id[:8]}")
     
     if not os.path.exists(full_path):
-        os.makedirs(full_path)
+        os.makedirs(full_path, exist_ok=True)
         print(f"📁 Created autosave folder at: {full_path}")
     
     st.session_state.autosave_dir = full_path
@@ -356,6 +497,28 @@ if 'current_session_name' not in st.session_state:
 if 'saved_sessions' not in st.session_state:
     st.session_state.saved_sessions = {}
 
+if 'current_session_id' not in st.session_state:
+    # Stable ID for the session's analytics rows; the name can change when it is saved
+    st.session_state.current_session_id = uuid.uuid4().hex
+
+if 'session_ids' not in st.session_state:
+    st.session_state.session_ids = {}  # saved session name -> session ID
+
+if 'active_batch' not in st.session_state:
+    st.session_state.active_batch = None
+
+if 'minhash_cache' not in st.session_state:
+    st.session_state.minhash_cache = {}
+
+if 'duplicate_flags' not in st.session_state:
+    st.session_state.duplicate_flags = {}
+
+if 'shared_feedback' not in st.session_state:
+    st.session_state.shared_feedback = {}
+
+if 'failed_grades' not in st.session_state:
+    st.session_state.failed_grades = {}  # dead-letter list: filename -> job, error, attempts
+
 client = anthropic.Anthropic(api_key=API_KEY)
 
 # --- 6. HELPER FUNCTIONS ---
@@ -419,6 +582,37 @@ def extract_text_from_docx(file):
     except Exception as e:
         return f"Error reading .docx file: {e}"
 
+def extract_text_from_pdf(file):
+    """Plain text of a PDF's text layer (empty for scans or when pypdf is not installed)."""
+    if PdfReader is None:
+        return ""
+    try:
+        file.seek(0)
+        reader = PdfReader(file)
+        return "\n".join((page.extract_text() or "") for page in reader.pages)
+    except Exception as e:
+        print(f"PDF text extraction failed: {e}")
+        return ""
+    finally:
+        file.seek(0)
+
+def get_submission_text(file):
+    """Student text used for duplicate detection (Word and PDF only; photos have no text)."""
+    ext = file.name.lower().split('.')[-1]
+    if ext == 'docx':
+        text = extract_text_from_docx(file)
+        return "" if text.startswith("Error reading .docx file") else text
+    if ext == 'pdf':
+        return extract_text_from_pdf(file)
+    return ""
+
+def file_content_hash(file):
+    """SHA-256 of the uploaded bytes (stable across reruns and re-uploads)."""
+    file.seek(0)
+    digest = hashlib.sha256(file.read()).hexdigest()
+    file.seek(0)
+    return digest
+
 def extract_images_from_docx(file):
     images = []
     try:
@@ -441,6 +635,149 @@ def extract_images_from_docx(file):
         print(f"Image extraction failed: {e}")
     return images
 
+# --- NEW: PHOTO SUBMISSIONS (ONE REQUEST PER STUDENT) ---
+IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
+# Only an explicit page marker makes a filename groupable by prefix ("smith_page2", "smith pg 2", "smith_p2");
+# bare trailing digits ("student1", "student2") are different students, not pages
+PAGE_MARKER_RE = re.compile(r"(?:[\s_\-.]*(?:page|pg)|[\s_\-.]+p)[\s_\-.]*\(?(\d+)\)?$", re.IGNORECASE)
+TRAILING_NUMBER_RE = re.compile(r"(\d+)\D*$")
+# Camera and messaging-app default names share a prefix (often a date) across the whole class
+CAMERA_NAME_RE = re.compile(
+    r"^(?:img|image|photo|pic|scan|dsc|dscn|dcim|pxl|mvimg|screenshot|whatsapp image|signal)(?:[\s_\-.]|\d|$)",
+    re.IGNORECASE,
+)
+DATE_TIME_STEM_RE = re.compile(r"\d{8}|\d{4}[\-_.]\d{2}[\-_.]\d{2}|^[\d\s_\-.()]+$")
+
+class PhotoSubmission(BytesIO):
+    """
+    One student's report sent as several page photos. Reads as the pages' concatenated bytes
+    (so hashing, resume and pre-flight treat it like any upload); `pages` keeps the ordered originals.
+    """
+    def __init__(self, student, pages):
+        self.pages = pages  # ordered (filename, bytes)
+        super().__init__(b"".join(data for _, data in pages))
+        self.name = f"{student} ({len(pages)} photos)"
+
+def photo_page_number(filename):
+    """Page order within a group: the explicit page marker, else the last number in the name."""
+    stem = os.path.splitext(filename)[0]
+    match = PAGE_MARKER_RE.search(stem) or TRAILING_NUMBER_RE.search(stem)
+    return int(match.group(1)) if match else 0
+
+def student_folders(photos):
+    """
+    Zip folders that hold one student's pages: below the archive's common root (so a zipped
+    class folder such as Period3/ is not one student) and holding more than one photo.
+    Returns {(archive, folder)}.
+    """
+    by_archive = defaultdict(lambda: defaultdict(int))
+    for photo in photos:
+        if hasattr(photo, "folder"):
+            by_archive[photo.archive][photo.folder] += 1
+    folders = set()
+    for archive, counts in by_archive.items():
+        root = os.path.commonpath(list(counts))
+        folders.update((archive, folder) for folder, count in counts.items() if folder != root and count > 1)
+    return folders
+
+def photo_student_key(file, mapping, folders=()):
+    """Which student a photo belongs to: explicit mapping, then student subfolder, then filename prefix."""
+    if file.name in mapping:
+        return mapping[file.name]
+    folder = getattr(file, "folder", "")
+    if (getattr(file, "archive", None), folder) in folders:
+        return os.path.basename(folder.rstrip("/"))
+    stem = os.path.splitext(file.name)[0]
+    if CAMERA_NAME_RE.match(stem) or DATE_TIME_STEM_RE.search(stem) or not PAGE_MARKER_RE.search(stem):
+        return None
+    return PAGE_MARKER_RE.sub("", stem).strip(" _-.") or None
+
+def parse_photo_mapping(text):
+    """'filename, student' lines (or CSV with those two columns) -> {filename: student}."""
+    mapping = {}
+    for line in (text or "").splitlines():
+        parts = [p.strip() for p in line.split(",")]
+        if len(parts) >= 2 and parts[0] and parts[1] and parts[0].lower() != "filename":
+            mapping[os.path.basename(parts[0])] = parts[1]
+    return mapping
+
+def group_photo_submissions(files, mapping=None):
+    """
+    Merge each student's page photos into one PhotoSubmission, ordered by page number.
+    Photos that match no one else (and every non-image file) pass through unchanged.
+    Returns (files, number of photos grouped).
+    """
+    mapping = mapping or {}
+    photos = [file for file in files if file.name.lower().split('.')[-1] in IMAGE_EXTENSIONS]
+    folders = student_folders(photos)
+    groups = defaultdict(list)
+    for file in photos:
+        key = photo_student_key(file, mapping, folders)
+        if key:
+            groups[key].append(file)
+    grouped, merged = {}, 0
+    for student, pages in groups.items():
+        if len(pages) < 2:
+            continue
+        pages.sort(key=lambda f: (photo_page_number(f.name), f.name.lower()))
+        page_data = []
+        for page in pages:
+            page.seek(0)
+            page_data.append((page.name, page.read()))
+            page.seek(0)
+        submission = PhotoSubmission(student, page_data)
+        for page in pages:
+            grouped[id(page)] = submission
+        merged += len(pages)
+    result, emitted = [], set()
+    for file in files:
+        submission = grouped.get(id(file))
+        if submission is None:
+            result.append(file)
+        elif id(submission) not in emitted:
+            emitted.add(id(submission))
+            result.append(submission)
+    return result, merged
+
+def fit_photo(data, max_edge, quality):
+    """Downscale a page photo to `max_edge` and re-encode it as JPEG. Returns (bytes, media type)."""
+    with Image.open(BytesIO(data)) as img:
+        img = img.convert("RGB")
+        img.thumbnail((max_edge, max_edge))
+        out = BytesIO()
+        img.save(out, format="JPEG", quality=quality, optimize=True)
+    return out.getvalue(), "image/jpeg"
+
+def photo_page_parts(submission):
+    """
+    Content parts for a photo submission: a 'Page i of n' label and the image for every page.
+    Pages are shrunk to the API's useful resolution and, if the whole set is still over
+    PHOTO_REQUEST_BUDGET, re-encoded smaller until it fits.
+    """
+    pages = submission.pages[:MAX_PHOTO_PAGES]
+    if len(submission.pages) > MAX_PHOTO_PAGES:
+        print(f"{submission.name}: only the first {MAX_PHOTO_PAGES} photos are sent.")
+    for max_edge, quality in PHOTO_BUDGET_STEPS:
+        encoded = []
+        for filename, data in pages:
+            if Image is None:
+                encoded.append((data, get_media_type(filename)))
+                continue
+            try:
+                encoded.append(fit_photo(data, max_edge, quality))
+            except Exception as e:
+                print(f"Could not resize {filename}: {e}")
+                encoded.append((data, get_media_type(filename)))
+        if Image is None or sum(len(d) for d, _ in encoded) * 4 / 3 <= PHOTO_REQUEST_BUDGET:
+            break
+    parts = []
+    for n, (data, media_type) in enumerate(encoded, 1):
+        parts.append({"type": "text", "text": f"Page {n} of {len(encoded)}:"})
+        parts.append({"type": "image", "source": {
+            "type": "base64", "media_type": media_type, "data": base64.b64encode(data).decode('utf-8')
+        }})
+    return parts
+
 def process_uploaded_files(uploaded_files):
     final_files = []
     IGNORED_FILES = {'.ds_store', 'desktop.ini', 'thumbs.db', '__macosx'}
@@ -464,6 +801,8 @@ def process_uploaded_files(uploaded_files):
                             file_bytes = z.read(filename)
                             virtual_file = BytesIO(file_bytes)
                             virtual_file.name = os.path.basename(filename)
+                            virtual_file.folder = os.path.dirname(filename)  # groups page photos by student
+                            virtual_file.archive = file.name
                             final_files.append(virtual_file)
                             if ext == 'docx': file_counts['docx'] += 1
                             elif ext == 'pdf': file_counts['pdf'] += 1
@@ -503,8 +842,8 @@ def recalculate_total_score(text):
 def parse_feedback_for_csv(text):
     data = {}
     
-    # 1. Clean Textual Decorators
-    clean_text = re.sub(r'[*#]', '', text) 
+    # 1. Clean Textual Decorators (and the hidden deduction-codes comment)
+    clean_text = re.sub(r'[*#]', '', DEDUCTION_CODES_COMMENT_RE.sub('', text)) 
     
     # 2. Extract Overall Summary
     try:
@@ -545,8 +884,352 @@ def clean_hidden_scratchpad(text):
     """Removes the internal <math_scratchpad> tags before displaying to the user."""
     return re.sub(r'<math_scratchpad>.*?</math_scratchpad>', '', text, flags=re.DOTALL | re.IGNORECASE).strip()
 
-def grade_submission(file, model_id):
+# --- LOCAL SCORING FROM DEDUCTION CODES ---
+SECTION_CODE_PREFIXES = {
+    "FORMATTING": "FMT", "INTRODUCTION": "INT", "HYPOTHESIS": "HYP", "VARIABLES": "VAR", "PROCEDURES": "PRO",
+    "RAW DATA": "RAW", "DATA ANALYSIS": "DA", "CONCLUSION": "CON", "EVALUATION": "EVA", "REFERENCES": "REF",
+}
+DEDUCTIONS_BLOCK_RE = re.compile(r"<deductions>(.*?)</deductions>", re.DOTALL | re.IGNORECASE)
+DEDUCTION_CODES_COMMENT_RE = re.compile(r"<!-- deduction-codes: (.*?) -->")
+HIDDEN_MATH_INSTRUCTION = "**HIDDEN MATH:** Use <math_scratchpad> tags for all calculations."
+DEDUCTION_CODES_INSTRUCTION = (
+    "**DEDUCTION CODES (NO MATH):** Do NOT write a math scratchpad or any arithmetic. Start your response with "
+    "<deductions>CODE, CODE, ...</deductions> listing every code from the DEDUCTION CODES list that applies "
+    "(exactly one REF- level code; use SECTION-OTHER=points only for a rubric criterion with no code). "
+    "Section and total scores are computed from these codes, so they must match your feedback."
+)
+
+def deduction_codes_prompt():
+    """The code list appended to the prompt in local-scoring mode."""
+    lines = ["--- DEDUCTION CODES ---"]
+    for code, (section, description, points, _) in DEDUCTION_RULES.items():
+        lines.append(f"{code} ({section.title()}, -{points:g}): {description}")
+    for code, (score, description) in REFERENCE_LEVELS.items():
+        lines.append(f"{code} (References = {score:g}/10): {description}")
+    lines.append("<PREFIX>-OTHER=x (-x, max 2): any other rubric deduction, e.g. RAW-OTHER=0.5. Prefixes: "
+                 + ", ".join(f"{p}={s.title()}" for s, p in SECTION_CODE_PREFIXES.items()))
+    lines.append("--- END DEDUCTION CODES ---")
+    return "\n".join(lines)
+
+SYSTEM_PROMPT_LOCAL_SCORING = SYSTEM_PROMPT.replace(
+    SYSTEM_PROMPT[SYSTEM_PROMPT.index("**CRITICAL INSTRUCTION:**"):SYSTEM_PROMPT.index("1.  INTRODUCTION (Section 2)")],
+    "**CRITICAL INSTRUCTION:** Do NOT perform or show any arithmetic. Report what you found as deduction codes in a "
+    "<deductions> block at the VERY START of your response; the scores are computed from the codes.\n\n"
+)
+
+def parse_deduction_codes(text):
+    """Codes listed in a <deductions> block (or a stored deduction-codes comment), in order."""
+    match = DEDUCTIONS_BLOCK_RE.search(text) or DEDUCTION_CODES_COMMENT_RE.search(text)
+    if not match:
+        return None
+    return [c.strip().upper().replace(' ', '') for c in re.split(r"[,\n;]+", match.group(1)) if c.strip()]
+
+def deduction_code_section(code):
+    """Rubric section a deduction code belongs to, or None for unknown codes."""
+    if code in DEDUCTION_RULES:
+        return DEDUCTION_RULES[code][0]
+    prefix = code.split('-', 1)[0]
+    return next((s for s, p in SECTION_CODE_PREFIXES.items() if p == prefix), None)
+
+def applied_deductions(codes):
+    """
+    The deductions that actually count, as {section: {group: (code, description, points)}}, plus the
+    References level code. Alternative codes in one group count once (largest wins); unknown codes are dropped.
+    """
+    applied = defaultdict(dict)
+    reference_level = None
+    for code in codes:
+        if code in REFERENCE_LEVELS:
+            reference_level = reference_level or code
+            continue
+        other = re.match(r"^[A-Z]+-OTHER=([\d.]+)$", code)
+        section = deduction_code_section(code)
+        if other and section:
+            applied[section][code] = (code, "other rubric deduction", min(float(other.group(1)), OTHER_DEDUCTION_MAX))
+            continue
+        if code not in DEDUCTION_RULES:
+            print(f"Ignoring unknown deduction code: {code}")
+            continue
+        section, description, points, group = DEDUCTION_RULES[code]
+        key = group or code
+        if points > applied[section].get(key, (None, None, -1.0))[2]:
+            applied[section][key] = (code, description, points)
+    return applied, reference_level
+
+def score_deduction_codes(codes):
+    """
+    Section scores from deduction codes: each section starts at 10 and never drops below 0;
+    References starts from its ladder level with the 4.0 minimum whenever the section exists.
+    Sections without a REF level code are left out.
+    """
+    applied, reference_level = applied_deductions(codes)
+    scores = {}
+    for section in RUBRIC_SECTIONS:
+        deducted = sum(points for _, _, points in applied[section].values())
+        if section == "REFERENCES":
+            if reference_level is None:
+                continue
+            base = REFERENCE_LEVELS[reference_level][0]
+            score = max(base - deducted, REFERENCES_FLOOR) if reference_level != "REF-NONE" else 0.0
+        else:
+            score = max(10.0 - deducted, 0.0)
+        scores[section] = score
+    return scores
+
+# Total line with whatever the model put in place of the number ("[Score]", "[X]", nothing at all)
+TOTAL_SCORE_LINE_RE = re.compile(r"^[#* \t]*📝\s*\**\s*SCORE:[^\n/]*/\s*100\**", re.M)
+
+def apply_local_scores(text, codes):
+    """
+    Overwrite each section's score in the feedback with the locally computed one, then write
+    the total line from those section scores (the model is told not to add anything up).
+    """
+    scores = score_deduction_codes(codes)
+    header = re.compile(
+        r"^([#* \t]*(?:10|[1-9])\.\s+(" + "|".join(RUBRIC_SECTIONS) + r")\b[^\n]*?:\s*\**\s*)([\d.?]+|\[Score\])(\s*/\s*10)", re.M
+    )
+    section_scores = {}
+    def replace(match):
+        score = scores.get(match.group(2))
+        if score is None:
+            # No code for this section (e.g. no REF level): keep the model's number if it gave one
+            try:
+                section_scores.setdefault(match.group(2), float(match.group(3)))
+            except ValueError:
+                pass
+            return match.group(0)
+        section_scores.setdefault(match.group(2), score)
+        return f"{match.group(1)}{score:g}{match.group(4)}"
+    text = header.sub(replace, text)
+    total = round(sum(section_scores.values()), 1)
+    total_line = f"# 📝 SCORE: {int(total) if total.is_integer() else total}/100"
+    if TOTAL_SCORE_LINE_RE.search(text):
+        return TOTAL_SCORE_LINE_RE.sub(total_line, text, count=1)
+    return total_line + "\n\n" + text
+
+def with_deduction_codes(user_message):
+    """Copy of a grading message that asks for deduction codes instead of a math scratchpad."""
+    message = [dict(part) for part in user_message]
+    for part in message:
+        if part.get("type") == "text":
+            part["text"] = part["text"].replace(HIDDEN_MATH_INSTRUCTION, DEDUCTION_CODES_INSTRUCTION)
+    first_text = next((p for p in message if p.get("type") == "text"), None)
+    if first_text is not None:
+        first_text["text"] += "\n\n" + deduction_codes_prompt()
+    return message
+
+def finalize_feedback(raw_text, local_scoring=False):
+    """Turn the model's raw reply into stored feedback: hidden blocks removed, scores computed locally or rechecked."""
+    text = clean_hidden_scratchpad(raw_text)
+    if local_scoring:
+        codes = parse_deduction_codes(text)
+        if codes is not None:
+            text = DEDUCTIONS_BLOCK_RE.sub('', text).strip()
+            text = apply_local_scores(text, codes)
+            # Keep the codes with the feedback (an HTML comment, dropped from Word and CSV exports) so the score is reproducible
+            text += f"\n\n<!-- deduction-codes: {', '.join(codes)} -->"
+        else:
+            print("Local scoring: no <deductions> block in reply, keeping the model's section scores.")
+    return recalculate_total_score(text)
+
+# --- UPLOAD-ONCE FILE REFERENCES (FILES API) ---
+class FileRefCache:
+    """
+    Content hash -> Files API file ID, so each PDF/photo is uploaded once and every retry,
+    regrade and model comparison afterwards sends a short reference instead of megabytes
+    of base64. Kept per Files API endpoint and appended to a JSONL file in the autosave folder.
+    """
+    def __init__(self, path, files_client, base_url):
+        self.path = path
+        self.files_client = files_client
+        self.base_url = base_url
+        self._ids = {}
+        self._lock = threading.Lock()
+        self._upload_locks = defaultdict(threading.Lock)
+        if os.path.exists(path):
+            try:
+                with open(path, encoding='utf-8') as f:
+                    for line in f:
+                        if line.strip():
+                            rec = json.loads(line)
+                            if rec.get("base_url") == base_url:
+                                self._ids[rec["sha256"]] = rec.get("file_id")
+            except Exception as e:
+                print(f"Could not load file reference cache: {e}")
+
+    def get_or_upload(self, data, filename, media_type):
+        digest = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            upload_lock = self._upload_locks[digest]
+        # One upload per content hash, even when several workers ask at once
+        with upload_lock:
+            file_id = self._ids.get(digest)
+            if file_id:
+                return file_id
+            uploaded = self.files_client.beta.files.upload(
+                file=(filename, data, media_type), betas=[FILES_API_BETA]
+            )
+            self._remember(digest, uploaded.id)
+            print(f"📎 Uploaded {filename} once as {uploaded.id}")
+            return uploaded.id
+
+    def forget(self, file_id):
+        with self._lock:
+            for digest, known in list(self._ids.items()):
+                if known == file_id:
+                    self._remember(digest, None)
+
+    def _remember(self, digest, file_id):
+        self._ids[digest] = file_id
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps({"base_url": self.base_url, "sha256": digest, "file_id": file_id}) + "\n")
+        except Exception as e:
+            print(f"Could not persist file reference: {e}")
+
+
+class LocalFilesServer:
+    """
+    Offline stand-in for the Files API (POST /v1/files, GET /v1/files/{id}[/content], DELETE),
+    storing uploads on disk. Select it with GRADER_FILES_API_BASE_URL=local to exercise the
+    upload-once path without network access; references are inlined again before sending.
+    """
+    def __init__(self, storage_dir):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        from email.parser import BytesParser
+        from email.policy import default as default_policy
+
+        os.makedirs(storage_dir, exist_ok=True)
+        self.storage_dir = storage_dir
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _send_json(self, status, payload):
+                body = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _file_id(self):
+                match = re.match(r"^/v1/files/(file_local_[0-9a-f]+)(/content)?$", self.path.split('?')[0])
+                return (match.group(1), bool(match.group(2))) if match else (None, False)
+
+            def do_POST(self):
+                if self.path.split('?')[0] != "/v1/files":
+                    return self._send_json(404, {"type": "error", "error": {"type": "not_found_error", "message": "Not found"}})
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                message = BytesParser(policy=default_policy).parsebytes(
+                    b"Content-Type: " + self.headers["Content-Type"].encode('latin-1') + b"\r\n\r\n" + body
+                )
+                part = next((p for p in message.iter_parts() if p.get_param("name", header="content-disposition") == "file"), None)
+                if part is None:
+                    return self._send_json(400, {"type": "error", "error": {"type": "invalid_request_error", "message": "file is required"}})
+                self._send_json(200, server.store(part.get_payload(decode=True), part.get_filename() or "unnamed", part.get_content_type()))
+
+            def do_GET(self):
+                file_id, content = self._file_id()
+                meta = server.metadata(file_id) if file_id else None
+                if meta is None:
+                    return self._send_json(404, {"type": "error", "error": {"type": "not_found_error", "message": f"File not found: {file_id}"}})
+                if not content:
+                    return self._send_json(200, meta)
+                data = server.content(file_id)
+                self.send_response(200)
+                self.send_header("Content-Type", meta["mime_type"])
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_DELETE(self):
+                file_id, _ = self._file_id()
+                if not file_id or server.metadata(file_id) is None:
+                    return self._send_json(404, {"type": "error", "error": {"type": "not_found_error", "message": f"File not found: {file_id}"}})
+                for suffix in (".bin", ".json"):
+                    os.remove(os.path.join(server.storage_dir, file_id + suffix))
+                self._send_json(200, {"id": file_id, "type": "file_deleted"})
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.base_url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        threading.Thread(target=self.httpd.serve_forever, name="local-files-api", daemon=True).start()
+
+    def store(self, data, filename, mime_type):
+        file_id = "file_local_" + hashlib.sha256(data).hexdigest()[:24]
+        meta = {
+            "id": file_id, "type": "file", "filename": os.path.basename(filename), "mime_type": mime_type,
+            "size_bytes": len(data), "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), "downloadable": True,
+        }
+        with open(os.path.join(self.storage_dir, file_id + ".bin"), 'wb') as f:
+            f.write(data)
+        with open(os.path.join(self.storage_dir, file_id + ".json"), 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        return meta
+
+    def metadata(self, file_id):
+        path = os.path.join(self.storage_dir, file_id + ".json")
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+
+    def content(self, file_id):
+        with open(os.path.join(self.storage_dir, file_id + ".bin"), 'rb') as f:
+            return f.read()
+
+
+@st.cache_resource
+def get_local_files_server():
+    return LocalFilesServer(os.path.join(AUTOSAVE_ROOT, "local_files_api"))
+
+@st.cache_resource
+def get_file_ref_cache():
+    if FILES_API_BASE_URL == "local":
+        base_url = get_local_files_server().base_url
+        files_client = anthropic.Anthropic(api_key=API_KEY, base_url=base_url)
+    else:
+        base_url = FILES_API_BASE_URL or "default"
+        files_client = anthropic.Anthropic(api_key=API_KEY, base_url=FILES_API_BASE_URL) if FILES_API_BASE_URL else client
+    return FileRefCache(os.path.join(AUTOSAVE_ROOT, "file_refs.jsonl"), files_client, base_url)
+
+def get_file_id(file, media_type):
+    """Files API ID for this upload (uploading it on first use), or None to fall back to base64."""
+    try:
+        file.seek(0)
+        data = file.read()
+        file.seek(0)
+        return get_file_ref_cache().get_or_upload(data, file.name, media_type)
+    except Exception as e:
+        print(f"Upload-once failed for {file.name}, sending inline instead: {e}")
+        return None
+
+def inline_local_file_refs(user_message):
+    """Swap stand-in server file references back to base64 (the real API cannot see local IDs)."""
+    server = get_local_files_server()
+    inlined = []
+    for block in user_message:
+        source = block.get("source", {})
+        if source.get("type") == "file":
+            meta = server.metadata(source["file_id"])
+            block = {**block, "source": {
+                "type": "base64", "media_type": meta["mime_type"],
+                "data": base64.b64encode(server.content(source["file_id"])).decode('utf-8'),
+            }}
+        inlined.append(block)
+    return inlined
+
+def sent_by_reference(file, upload_once):
+    """Whether upload-once mode sends this file as a Files API reference (photo submissions are budgeted and sent inline, page by page)."""
+    return upload_once and not file.name.lower().endswith('.docx') and not isinstance(file, PhotoSubmission)
+
+def build_grade_message(file, upload_once=False):
+    """The user message that grades `file`, plus the Files API ID it references (None when sent inline)."""
     ext = file.name.split('.')[-1].lower()
+    file_id = None
     
     if ext == 'docx':
         text_content = extract_text_from_docx(file)
@@ -583,9 +1266,16 @@ def grade_submission(file, model_id):
         if images:
             user_message.extend(images)
     else:
-        base64_data = encode_file(file)
-        if not base64_data: return "Error processing file."
         media_type = get_media_type(file.name)
+        file_id = get_file_id(file, media_type) if sent_by_reference(file, upload_once) else None
+        if isinstance(file, PhotoSubmission):
+            source = None
+        elif file_id:
+            source = {"type": "file", "file_id": file_id}
+        else:
+            base64_data = encode_file(file)
+            if not base64_data: raise GradingError(f"Could not read {file.name}.")
+            source = {"type": "base64", "media_type": media_type, "data": base64_data}
         
         prompt_text = (
             "Please grade this lab report based on the Pre-IB rubric below.\n\n"
@@ -607,47 +1297,819 @@ def grade_submission(file, model_id):
             "14. **TOP 3 ACTIONABLE STEPS:** You MUST provide exactly THREE specific, concrete, actionable recommendations at the end of your feedback.\n"
         )
         
-        user_message = [
-            {"type": "text", "text": prompt_text},
-            {
-                "type": "document" if media_type == 'application/pdf' else "image",
-                "source": {"type": "base64", "media_type": media_type, "data": base64_data}
+        if isinstance(file, PhotoSubmission):
+            note = (f"Note: This report was submitted as {len(file.pages)} photos of its pages, attached below in page "
+                    "order. Treat them together as ONE lab report and grade it once.\n\n")
+            user_message = [{"type": "text", "text": note + prompt_text}] + photo_page_parts(file)
+        else:
+            user_message = [
+                {"type": "text", "text": prompt_text},
+                {
+                    "type": "document" if media_type == 'application/pdf' else "image",
+                    "source": source
+                }
+            ]
+
+    return user_message, file_id
+
+def grade_submission(file, model_id, upload_once=False, local_scoring=False):
+    user_message, file_id = build_grade_message(file, upload_once)
+    if file_id:
+        try:
+            return request_grade(user_message, model_id, betas=[FILES_API_BETA], local_scoring=local_scoring)
+        except GradingError as e:
+            if not is_missing_file_ref(e, file_id):
+                raise
+            # Upload expired or was deleted: forget the reference and send the bytes this once
+            get_file_ref_cache().forget(file_id)
+            return grade_submission(file, model_id, local_scoring=local_scoring)
+    return request_grade(user_message, model_id, local_scoring=local_scoring)
+
+# --- NEW: DEADLINES & HEDGED REQUESTS ---
+class GradingError(Exception):
+    """
+    A report could not be graded. Raised instead of returning feedback, so a failure is never stored,
+    autosaved or resumed as if it were a grade. `transient` failures (overloads, rate limits, timeouts)
+    are worth retrying later; the rest (unreadable file, rejected request) need a person to look.
+    """
+    def __init__(self, message, transient=False, status_code=None, cause=None):
+        super().__init__(message)
+        self.transient = transient
+        self.status_code = status_code
+        self.cause = cause
+
+def is_missing_file_ref(error, file_id):
+    """True when the API rejected a request because an uploaded file reference expired or was deleted."""
+    cause = error.cause
+    if isinstance(cause, anthropic.NotFoundError):
+        return True
+    if error.status_code not in (400, 404):
+        return False
+    detail = f"{getattr(cause, 'body', '')} {getattr(cause, 'message', '')}"
+    return "file_id" in detail or file_id in detail
+
+def is_failed_grade(item):
+    """Older sessions stored failures as results whose feedback starts with an error marker."""
+    return item.get('Feedback', '').startswith("⚠️ Error")
+
+class GradeDeadlineExceeded(Exception):
+    """A grading request (and its hedge, if any) ran past its deadline."""
+
+class LatencyTracker:
+    """
+    Rolling window of successful grading latencies, shared by every session on this deployment.
+    Turns them into a per-request deadline and a hedge delay (p95), and enforces the hedge budget.
+    """
+    def __init__(self, window=500, hedge_budget=HEDGE_BUDGET):
+        self.latencies = deque(maxlen=window)
+        self.hedge_budget = hedge_budget
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.timeouts = 0
+        self.lock = threading.Lock()
+
+    def percentile(self, q):
+        with self.lock:
+            if len(self.latencies) < LATENCY_MIN_SAMPLES:
+                return None
+            return float(np.percentile(np.fromiter(self.latencies, dtype=float), q))
+
+    def deadline(self):
+        p99 = self.percentile(99)
+        if p99 is None:
+            return GRADE_DEFAULT_DEADLINE
+        return max(GRADE_MIN_DEADLINE, GRADE_DEADLINE_MULTIPLIER * p99)
+
+    def hedge_delay(self):
+        """Seconds after which a still-running request gets a duplicate, or None while warming up."""
+        return self.percentile(95)
+
+    def start_request(self):
+        with self.lock:
+            self.requests += 1
+
+    def try_hedge(self):
+        """Claim a hedge from the budget; False once hedges would exceed the allowed share of requests."""
+        with self.lock:
+            if self.hedges + 1 > self.hedge_budget * self.requests:
+                return False
+            self.hedges += 1
+            return True
+
+    def record(self, seconds, hedge_won=False):
+        with self.lock:
+            self.latencies.append(seconds)
+            self.hedge_wins += int(hedge_won)
+
+    def record_timeout(self):
+        with self.lock:
+            self.timeouts += 1
+
+    def stats(self):
+        p50, p95, p99 = self.percentile(50), self.percentile(95), self.percentile(99)
+        fmt = lambda v: "warming up" if v is None else f"{v:.1f}s"
+        with self.lock:
+            return {
+                "Requests": self.requests, "Latency p50": fmt(p50), "Latency p95 (hedge after)": fmt(p95),
+                "Latency p99": fmt(p99), "Hedges sent": self.hedges, "Hedges won": self.hedge_wins,
+                "Deadline misses": self.timeouts,
             }
-        ]
 
+@st.cache_resource
+def get_latency_tracker():
+    """One tracker per server process, so every session learns from the same latencies."""
+    return LatencyTracker()
+
+def stream_message(request, betas, deadline, cancel):
+    """
+    Stream one Messages API call so it can be abandoned mid-generation: returns the final message,
+    or None once `cancel` is set. Closing the stream drops the connection, so a cancelled hedge stops costing tokens.
+    """
+    api = client.with_options(timeout=deadline, max_retries=0)
+    started = time.monotonic()
+    if betas:
+        manager = api.beta.messages.stream(betas=betas, **request)
+    else:
+        manager = api.messages.stream(**request)
+    with manager as stream:
+        for _ in stream:
+            if cancel.is_set():
+                return None
+            if time.monotonic() - started > deadline:
+                raise GradeDeadlineExceeded(f"No complete response within {deadline:.0f}s")
+        return stream.get_final_message()
+
+def send_grade_request(request, betas=None):
+    """
+    Send one request under a deadline of 2x the observed p99 latency. If it is still running at the
+    p95 mark (and the hedge budget allows), an identical duplicate is sent; the first successful reply
+    wins and the other is cancelled. Raises the last API error, or GradeDeadlineExceeded.
+    A hedge takes a free GradingScheduler slot like any other call, and is skipped when none is free.
+    """
+    tracker = get_latency_tracker()
+    scheduler = get_grading_scheduler()
+    deadline, hedge_after = tracker.deadline(), tracker.hedge_delay()
+    outcomes = queue.Queue()
+    cancels = []
+
+    def attempt(cancel, hedge):
+        try:
+            message = stream_message(request, betas, deadline, cancel)
+            if message is not None:
+                outcomes.put(("ok", message, hedge))
+        except Exception as e:
+            outcomes.put(("error", e, hedge))
+        finally:
+            if hedge:
+                scheduler.release_hedge_slot()
+
+    def launch(hedge=False):
+        cancel = threading.Event()
+        cancels.append(cancel)
+        threading.Thread(target=attempt, args=(cancel, hedge), daemon=True).start()
+
+    tracker.start_request()
+    started = time.monotonic()
+    launch()
+    running, last_error = 1, None
+    try:
+        while running:
+            elapsed = time.monotonic() - started
+            wait = deadline - elapsed
+            if hedge_after is not None:
+                wait = min(wait, hedge_after - elapsed)
+            try:
+                status, value, hedge = outcomes.get(timeout=max(wait, 0.0))
+            except queue.Empty:
+                if time.monotonic() - started >= deadline:
+                    break
+                if hedge_after is not None and scheduler.try_hedge_slot():
+                    if tracker.try_hedge():
+                        print(f"⏳ Request still running after p95 ({hedge_after:.1f}s); sending a hedged duplicate.")
+                        launch(hedge=True)
+                        running += 1
+                    else:
+                        scheduler.release_hedge_slot()
+                hedge_after = None
+                continue
+            running -= 1
+            if status == "ok":
+                # Latency as the caller saw it: from the original send, even when the hedge won.
+                tracker.record(time.monotonic() - started, hedge_won=hedge)
+                return value
+            last_error = value
+    finally:
+        for cancel in cancels:
+            cancel.set()
+    if running == 0 and last_error is not None:
+        raise last_error
+    tracker.record_timeout()
+    raise GradeDeadlineExceeded(f"No response within the {deadline:.0f}s deadline")
+
+# --- NEW: RECORD & REPLAY ---
+class RecordingStore:
+    """
+    Compact on-disk record of grading calls (SQLite, zlib-compressed bodies) keyed by request
+    fingerprint, plus named regression baselines: the pipeline outputs and timings a saved class
+    produced, so prompt/parser/exporter changes can be checked offline against them.
+    """
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS calls (
+                    fingerprint TEXT PRIMARY KEY, model TEXT, local_scoring INTEGER, recorded_at TEXT,
+                    latency REAL, input_tokens INTEGER, output_tokens INTEGER, response BLOB);
+                CREATE TABLE IF NOT EXISTS baselines (
+                    name TEXT, filename TEXT, fingerprint TEXT, score TEXT, feedback BLOB, csv_row TEXT,
+                    docx_sha TEXT, pipeline_ms REAL, PRIMARY KEY (name, filename));
+                CREATE TABLE IF NOT EXISTS baseline_runs (
+                    name TEXT PRIMARY KEY, created_at TEXT, reports INTEGER, export_ms REAL);
+            """)
+
+    def record(self, fingerprint, request, raw_text, latency, usage=None):
+        row = (fingerprint, request["model"], int(request["system"] == SYSTEM_PROMPT_LOCAL_SCORING),
+               time.strftime("%Y-%m-%dT%H:%M:%S"), latency, getattr(usage, "input_tokens", None),
+               getattr(usage, "output_tokens", None), zlib.compress(raw_text.encode("utf-8")))
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO calls VALUES (?, ?, ?, ?, ?, ?, ?, ?)", row)
+
+    def call(self, fingerprint):
+        """(raw response text, local_scoring, latency) of a recorded call, or None."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT response, local_scoring, latency FROM calls WHERE fingerprint = ?", (fingerprint,)
+            ).fetchone()
+        if row is None:
+            return None
+        return zlib.decompress(row[0]).decode("utf-8"), bool(row[1]), row[2]
+
+    def save_baseline(self, name, rows, export_ms):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM baselines WHERE name = ?", (name,))
+            self.conn.executemany("INSERT INTO baselines VALUES (?, ?, ?, ?, ?, ?, ?, ?)", [
+                (name, r["Filename"], r["fingerprint"], r["score"], zlib.compress(r["feedback"].encode("utf-8")),
+                 json.dumps(r["csv_row"], sort_keys=True), r["docx_sha"], r["pipeline_ms"]) for r in rows
+            ])
+            self.conn.execute("INSERT OR REPLACE INTO baseline_runs VALUES (?, ?, ?, ?)",
+                              (name, time.strftime("%Y-%m-%dT%H:%M:%S"), len(rows), export_ms))
+
+    def baseline_names(self):
+        with self.lock:
+            return [r[0] for r in self.conn.execute("SELECT name FROM baseline_runs ORDER BY created_at DESC")]
+
+    def baseline(self, name):
+        """(rows, export_ms) of a saved baseline."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT filename, fingerprint, score, feedback, csv_row, docx_sha, pipeline_ms FROM baselines "
+                "WHERE name = ? ORDER BY filename", (name,)
+            ).fetchall()
+            run = self.conn.execute("SELECT export_ms FROM baseline_runs WHERE name = ?", (name,)).fetchone()
+        return [{
+            "Filename": f, "fingerprint": fp, "score": score, "feedback": zlib.decompress(fb).decode("utf-8"),
+            "csv_row": json.loads(csv_row), "docx_sha": sha, "pipeline_ms": ms,
+        } for f, fp, score, fb, csv_row, sha, ms in rows], (run[0] if run else None)
+
+@st.cache_resource
+def get_recording_store():
+    os.makedirs(AUTOSAVE_ROOT, exist_ok=True)
+    return RecordingStore(os.path.join(AUTOSAVE_ROOT, "recordings.sqlite"))
+
+_job_calls = threading.local()  # fingerprints of the calls made by the grading job on this thread
+
+def request_fingerprint(request, betas=None):
+    """Stable hash of everything that determines a grading reply."""
+    canonical = json.dumps({"betas": sorted(betas or []), **request}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+def send_recorded(request, betas=None):
+    """
+    Return the raw reply text for a grading request. Live calls are recorded; in replay mode
+    (GRADER_API_MODE=replay) the recorded reply is returned instead and the API is never called.
+    """
+    store = get_recording_store()
+    fingerprint = request_fingerprint(request, betas)
+    if API_MODE == "replay":
+        recorded = store.call(fingerprint)
+        if recorded is None:
+            raise GradingError("Replay mode: no recorded response for this request.")
+        raw_text = recorded[0]
+    else:
+        started = time.monotonic()
+        response = send_grade_request(request, betas)
+        raw_text = response.content[0].text
+        if RECORD_CALLS:
+            try:
+                store.record(fingerprint, request, raw_text, time.monotonic() - started, getattr(response, "usage", None))
+            except Exception as e:
+                print(f"Recording failed: {e}")
+    if getattr(_job_calls, "fingerprints", None) is not None:
+        _job_calls.fingerprints.append(fingerprint)
+    return raw_text
+
+def replay_pipeline(raw_text, local_scoring):
+    """Run one recorded reply through every local stage: cleanup, scoring, CSV parsing and Word rendering."""
+    started = time.perf_counter()
+    feedback = finalize_feedback(raw_text, local_scoring)
+    csv_row = parse_feedback_for_csv(feedback)
+    renderer = get_docx_renderer()
+    body = renderer.body_xml(feedback)
+    renderer.package([body])
+    return {
+        "feedback": feedback, "score": parse_score(feedback), "csv_row": csv_row,
+        "docx_sha": hashlib.sha256(body.encode("utf-8")).hexdigest(),
+        "pipeline_ms": (time.perf_counter() - started) * 1000,
+    }
+
+def replayable(item):
+    """The single recorded call behind a result; shared, merged or unrecorded grades cannot be replayed."""
+    calls = item.get("Recorded Calls") or []
+    return calls[0] if len(calls) == 1 and not item['Feedback'].startswith("**♻️ RESUBMISSION") else None
+
+def time_exports(results, name):
+    started = time.perf_counter()
+    for spool in build_exports(results, name):
+        spool.close()
+    return (time.perf_counter() - started) * 1000
+
+def save_replay_baseline(name, results):
+    """Snapshot what the current code produces from a class's recorded replies. Returns (saved, skipped)."""
+    store = get_recording_store()
+    rows, skipped = [], 0
+    for item in results:
+        fingerprint = replayable(item)
+        recorded = store.call(fingerprint) if fingerprint else None
+        if recorded is None:
+            skipped += 1
+            continue
+        rows.append({"Filename": item['Filename'], "fingerprint": fingerprint, **replay_pipeline(*recorded[:2])})
+    export_ms = time_exports([{"Filename": r["Filename"], "Score": r["score"], "Feedback": r["feedback"]} for r in rows], name)
+    store.save_baseline(name, rows, export_ms)
+    return len(rows), skipped
+
+def run_replay(name):
+    """Rerun a baseline's recorded replies through the current code and diff outputs and timings."""
+    store = get_recording_store()
+    baseline, baseline_export_ms = store.baseline(name)
+    report, diffs, replayed = [], {}, []
+    for row in baseline:
+        recorded = store.call(row["fingerprint"])
+        if recorded is None:
+            report.append({"Filename": row["Filename"], "Status": "recording missing"})
+            continue
+        now = replay_pipeline(*recorded[:2])
+        replayed.append({"Filename": row["Filename"], "Score": now["score"], "Feedback": now["feedback"]})
+        csv_changed = sorted(k for k in set(row["csv_row"]) | set(now["csv_row"])
+                             if row["csv_row"].get(k) != now["csv_row"].get(k))
+        changed = []
+        if now["score"] != row["score"]:
+            changed.append("score")
+        if now["feedback"] != row["feedback"]:
+            changed.append("feedback")
+            diffs[row["Filename"]] = "\n".join(difflib.unified_diff(
+                row["feedback"].splitlines(), now["feedback"].splitlines(), "baseline", "replay", lineterm="", n=1))
+        if csv_changed:
+            changed.append("csv: " + ", ".join(csv_changed))
+        if now["docx_sha"] != row["docx_sha"]:
+            changed.append("word")
+        report.append({
+            "Filename": row["Filename"], "Status": "changed" if changed else "same",
+            "Score": row["score"] if now["score"] == row["score"] else f"{row['score']} → {now['score']}",
+            "Changed": "; ".join(changed), "Baseline ms": round(row["pipeline_ms"], 1),
+            "Replay ms": round(now["pipeline_ms"], 1),
+        })
+    exports = {"baseline_ms": baseline_export_ms, "replay_ms": time_exports(replayed, name) if replayed else None}
+    return pd.DataFrame(report), diffs, exports
+
+def build_grade_request(user_message, model_id, local_scoring=False):
+    """Messages API parameters for one grading call."""
+    if local_scoring:
+        user_message = with_deduction_codes(user_message)
+    # Temperature=0 for Maximum Consistency
+    return dict(
+        model=model_id, 
+        max_tokens=GRADE_MAX_TOKENS,
+        temperature=0.0,
+        system=SYSTEM_PROMPT_LOCAL_SCORING if local_scoring else SYSTEM_PROMPT,
+        messages=[{"role": "user", "content": user_message}]
+    )
+
+def request_grade(user_message, model_id, betas=None, local_scoring=False):
+    """
+    Send one grading request (retrying overloads and rate limits) and return the cleaned feedback.
+    With local_scoring the model lists deduction codes instead of doing the math, and the scores are computed here.
+    Raises GradingError when no feedback could be produced.
+    """
     max_retries = 5 
     retry_delay = 5 
+    if betas and FILES_API_BASE_URL == "local":
+        user_message = inline_local_file_refs(user_message)
+        betas = None
+    request = build_grade_request(user_message, model_id, local_scoring)
     
     for attempt in range(max_retries):
         try:
-            # Temperature=0 for Maximum Consistency
-            response = client.messages.create(
-                model=model_id, 
-                max_tokens=4096,
-                temperature=0.0,
-                system=SYSTEM_PROMPT,
-                messages=[{"role": "user", "content": user_message}]
-            )
-            raw_text = response.content[0].text
-            cleaned_text = clean_hidden_scratchpad(raw_text)
-            corrected_text = recalculate_total_score(cleaned_text)
-            return corrected_text
+            raw_text = send_recorded(request, betas)
+            return finalize_feedback(raw_text, local_scoring)
             
+        except (GradeDeadlineExceeded, anthropic.APIConnectionError) as e:
+            # Covers timeouts too: a stalled call is cut off at its deadline and sent again
+            print(f"⚠️ {type(e).__name__}: {e}. Retrying attempt {attempt+1}/{max_retries}...")
+            time.sleep(retry_delay * (attempt + 1))
+            continue
+
         except (anthropic.RateLimitError, anthropic.APIStatusError) as e:
-            if isinstance(e, anthropic.APIStatusError) and e.status_code == 529:
+            # Overloads can also arrive mid-stream, as an error event on a 200 response
+            if isinstance(e, anthropic.APIStatusError) and (e.status_code == 529 or "overloaded" in str(e).lower()):
                 print(f"⚠️ Server Overloaded (529). Retrying attempt {attempt+1}/{max_retries}...")
                 time.sleep(retry_delay * (attempt + 1))
                 continue
+
+            if isinstance(e, anthropic.InternalServerError):
+                print(f"⚠️ Server Error ({e.status_code}). Retrying attempt {attempt+1}/{max_retries}...")
+                time.sleep(retry_delay * (attempt + 1))
+                continue
             
             if isinstance(e, anthropic.RateLimitError):
                 print(f"⚠️ Rate Limit Hit. Retrying attempt {attempt+1}/{max_retries}...")
                 time.sleep(retry_delay * (attempt + 1))
                 continue
                 
-            return f"⚠️ Error: {str(e)}"
+            raise GradingError(f"API error: {e}", status_code=e.status_code, cause=e) from e
+
+        except GradingError:
+            raise
             
         except Exception as e:
-            return f"⚠️ Error: {str(e)}"
+            raise GradingError(f"Unexpected error: {e}", cause=e) from e
+
+    raise GradingError(f"Gave up after {max_retries} attempts (server overloaded, rate limited or timed out).", transient=True)
+
+# --- RESUBMISSIONS: SECTION-LEVEL INCREMENTAL REGRADE ---
+RUBRIC_SECTIONS = [
+    "FORMATTING", "INTRODUCTION", "HYPOTHESIS", "VARIABLES", "PROCEDURES",
+    "RAW DATA", "DATA ANALYSIS", "CONCLUSION", "EVALUATION", "REFERENCES",
+]
+
+# How each rubric section is usually headed in a student's report (checked in this order).
+# FORMATTING is judged over the whole document, so it has no heading of its own.
+STUDENT_HEADING_PATTERNS = [
+    ("EVALUATION", re.compile(r"^\W*(?:\d+[.)]?\s*)?(evaluation|sources? of error|errors?\b|limitations|improvements)", re.I)),
+    ("REFERENCES", re.compile(r"^\W*(?:\d+[.)]?\s*)?(references|bibliography|works cited|citations|sources\b|acknowledg)", re.I)),
+    ("HYPOTHESIS", re.compile(r"^\W*(?:\d+[.)]?\s*)?(hypothesis|prediction)", re.I)),
+    ("VARIABLES", re.compile(r"^\W*(?:\d+[.)]?\s*)?variables?\b", re.I)),
+    ("PROCEDURES", re.compile(r"^\W*(?:\d+[.)]?\s*)?(procedures?|method|materials|apparatus|equipment|safety)", re.I)),
+    ("DATA ANALYSIS", re.compile(r"^\W*(?:\d+[.)]?\s*)?(data analysis|analysis|processed data|data processing|calculations?)", re.I)),
+    ("RAW DATA", re.compile(r"^\W*(?:\d+[.)]?\s*)?(raw data|data collection|data table|observations|results)", re.I)),
+    ("CONCLUSION", re.compile(r"^\W*(?:\d+[.)]?\s*)?(conclusion|discussion)", re.I)),
+    ("INTRODUCTION", re.compile(r"^\W*(?:\d+[.)]?\s*)?(introduction|background|objective|aim\b|purpose|research question)", re.I)),
+]
+
+# Section headers in our own feedback, e.g. "**8. CONCLUSION: 7.5/10**"
+FEEDBACK_SECTION_RE = re.compile(r"^[#* \t]*(?:10|[1-9])\.\s+(" + "|".join(RUBRIC_SECTIONS) + r")\b", re.M)
+
+# Sections whose grade depends on the report's embedded images (graphs, setup photos)
+IMAGE_SECTIONS = ("PROCEDURES", "RAW DATA", "DATA ANALYSIS")
+MIN_SECTIONS_DETECTED = 6  # below this the headings are too unusual to trust a section split
+MAX_HEADING_WORDS = 5
+AMBIGUOUS_SPLIT = "AMBIGUOUS"  # sections headed more than once: the split cannot be trusted
+
+def looks_like_heading(line):
+    """A short label rather than a sentence: few words and no sentence punctuation (before any "Label:" colon)."""
+    label = re.sub(r'^\W*\d+[.)]?\s*', '', line).split(":", 1)[0].strip()
+    return 0 < len(label.split()) <= MAX_HEADING_WORDS and not re.search(r'[.!?;,]', label)
+
+def split_report_sections(text):
+    """
+    Split extracted report text into rubric sections by the student's own headings.
+    A section that starts again after another one lists its name under AMBIGUOUS_SPLIT.
+    """
+    body, _, tables = text.partition("\n--- DETECTED TABLES ---\n")
+    sections = defaultdict(list)
+    current = "PREAMBLE"
+    repeated = []
+    for line in body.split("\n"):
+        stripped = re.sub(r'</?su[bp]>', '', line).strip()
+        if 0 < len(stripped) <= 60 and looks_like_heading(stripped):
+            heading = next((name for name, pattern in STUDENT_HEADING_PATTERNS if pattern.match(stripped)), None)
+            if heading and heading != current:
+                if heading in sections:
+                    repeated.append(heading)
+                current = heading
+        sections[current].append(line)
+    if tables.strip():
+        sections["RAW DATA"].append(tables)
+    split = {name: "\n".join(lines).strip() for name, lines in sections.items()}
+    if repeated:
+        split[AMBIGUOUS_SPLIT] = ", ".join(repeated)
+    return split
+
+def _fingerprint(text):
+    normalized = re.sub(r'\s+', ' ', text).strip()
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()[:16] if normalized else None
+
+def section_fingerprints(text, images):
+    """Per-section content hashes of a Word report, stored alongside its Feedback."""
+    sections = split_report_sections(text)
+    fingerprints = {name: _fingerprint(sections.get(name, "")) for name in RUBRIC_SECTIONS[1:]}
+    if AMBIGUOUS_SPLIT in sections:
+        fingerprints[AMBIGUOUS_SPLIT] = sections[AMBIGUOUS_SPLIT]
+    fingerprints["IMAGES"] = hashlib.sha256(
+        b"".join(img["source"]["data"].encode('ascii') for img in images)
+    ).hexdigest()[:16]
+    return fingerprints
+
+def plan_incremental_regrade(fingerprints, prior_fingerprints):
+    """Rubric sections to regrade, or None when a full regrade is the safer choice."""
+    headed = RUBRIC_SECTIONS[1:]
+    if not prior_fingerprints or sum(1 for n in headed if fingerprints.get(n)) < MIN_SECTIONS_DETECTED:
+        return None
+    if AMBIGUOUS_SPLIT in fingerprints or AMBIGUOUS_SPLIT in prior_fingerprints:
+        return None
+    changed = [n for n in headed if fingerprints.get(n) != prior_fingerprints.get(n)]
+    if fingerprints.get("IMAGES") != prior_fingerprints.get("IMAGES"):
+        changed += [n for n in IMAGE_SECTIONS if n not in changed]
+    # Formatting is a whole-document judgement: only a full regrade re-scores it
+    if len(changed) > len(headed) // 2:
+        return None
+    return [n for n in headed if n in changed]
+
+def feedback_section_blocks(text):
+    """Map each rubric section to the (start, end) span of its block in a feedback text."""
+    headers = list(FEEDBACK_SECTION_RE.finditer(text))
+    spans = {}
+    for i, match in enumerate(headers):
+        end = headers[i + 1].start() if i + 1 < len(headers) else len(text)
+        tail = re.search(r"^.*💡", text[match.start():end], re.M)
+        if tail:
+            end = match.start() + tail.start()
+        spans[match.group(1)] = (match.start(), end)
+    return spans
+
+def merge_section_feedback(prior_feedback, new_feedback, changed):
+    """Replace the changed sections' blocks in the prior feedback; everything else carries over."""
+    new_blocks = feedback_section_blocks(new_feedback)
+    missing = [n for n in changed if n not in new_blocks]
+    if missing:
+        raise ValueError(f"regrade did not return section(s): {', '.join(missing)}")
+    prior_blocks = feedback_section_blocks(prior_feedback)
+    merged = prior_feedback
+    # Replace back-to-front so earlier spans stay valid
+    for name in sorted(changed, key=lambda n: prior_blocks.get(n, (-1,))[0], reverse=True):
+        if name not in prior_blocks:
+            raise ValueError(f"previous feedback has no {name} section")
+        start, end = prior_blocks[name]
+        block = new_feedback[slice(*new_blocks[name])].strip() + "\n\n"
+        merged = merged[:start] + block + merged[end:]
+    return recalculate_total_score(merged)
+
+def resubmission_key(filename):
+    """Student key shared by a report and its resubmissions (e.g. 'Smith_v2.docx' -> 'smith')."""
+    stem = os.path.splitext(filename)[0].lower()
+    suffix = r"[\s_\-]*(v\d+|version\s*\d+|final|revised|revision|resubmi\w*|redo|corrected|updated|copy|\(\d+\))$"
+    while True:
+        shorter = re.sub(suffix, "", stem).strip()
+        if shorter == stem or not shorter:
+            return stem
+        stem = shorter
+
+def find_prior_submission(filename, content_hash):
+    """Most recent earlier grade of the same student's report that recorded section fingerprints."""
+    key = resubmission_key(filename)
+    histories = list(st.session_state.saved_sessions.values()) + [st.session_state.current_results]
+    prior = None
+    for results in histories:
+        for item in results:
+            if (item.get("Section Fingerprints") and item.get("Content Hash") != content_hash
+                    and not is_failed_grade(item)
+                    and resubmission_key(item['Filename']) == key):
+                prior = item
+    return prior
+
+def grade_resubmission(file, model_id, prior, local_scoring=False):
+    """
+    Regrade only the sections of a Word report that changed since `prior` was graded.
+    Returns (feedback, fingerprints); falls back to a full regrade when the split is unreliable.
+    """
+    text_content = extract_text_from_docx(file)
+    images = extract_images_from_docx(file)
+    fingerprints = section_fingerprints(text_content, images)
+    changed = plan_incremental_regrade(fingerprints, prior.get("Section Fingerprints"))
+    if changed is None:
+        return grade_submission(file, model_id, local_scoring=local_scoring), fingerprints
+    if not changed:
+        return prior['Feedback'], fingerprints
+
+    sections = split_report_sections(text_content)
+    numbered = [f"{RUBRIC_SECTIONS.index(n) + 1}. {n}" for n in changed]
+    prompt_text = (
+        "This is a RESUBMISSION of a lab report that was already graded against the Pre-IB rubric below.\n"
+        f"Only these sections changed: {', '.join(numbered)}.\n\n"
+        "INSTRUCTIONS:\n"
+        "1. Grade ONLY the changed sections listed above, applying the rubric exactly as for a new report.\n"
+        "2. Output ONLY those sections' blocks, in this exact format and nothing else (no SCORE line, no summary, no actionable steps):\n"
+        "**N. SECTION NAME: [Score]/10**\n* **✅ Strengths:** ...\n* **⚠️ Improvements:** ...\n"
+        "3. **FORMATTING DETECTION:** Subscripts appear as <sub>text</sub>. Superscripts appear as <sup>text</sup>. If these tags are present, the student formatted it CORRECTLY.\n"
+        "4. **HIDDEN MATH:** Use <math_scratchpad> tags for all calculations.\n\n"
+        "--- RUBRIC START ---\n" + PRE_IB_RUBRIC + "\n--- RUBRIC END ---\n\n"
+        "CHANGED SECTIONS OF THE STUDENT TEXT:\n"
+        + "\n\n".join(f"=== {n} ===\n{sections.get(n, '[SECTION NOT FOUND]')}" for n in changed)
+    )
+    user_message = [{"type": "text", "text": prompt_text}]
+    if any(n in IMAGE_SECTIONS for n in changed):
+        user_message.extend(images)
+
+    new_feedback = request_grade(user_message, model_id, local_scoring=local_scoring)
+    prior_feedback = re.sub(r"\A\*\*♻️ RESUBMISSION:\*\*[^\n]*\n+", "", prior['Feedback'])
+    prior_codes, new_codes = parse_deduction_codes(prior_feedback), parse_deduction_codes(new_feedback)
+    try:
+        merged = merge_section_feedback(DEDUCTION_CODES_COMMENT_RE.sub('', prior_feedback).rstrip(),
+                                        DEDUCTION_CODES_COMMENT_RE.sub('', new_feedback).rstrip(), changed)
+    except ValueError as e:
+        print(f"Incremental regrade of {file.name} fell back to a full regrade: {e}")
+        return grade_submission(file, model_id, local_scoring=local_scoring), fingerprints
+    if prior_codes is not None and new_codes is not None:
+        # Carry the unchanged sections' codes over so the stored set still explains every score
+        codes = [c for c in prior_codes if deduction_code_section(c) not in changed] + new_codes
+        merged += f"\n\n<!-- deduction-codes: {', '.join(codes)} -->"
+    note = (f"**♻️ RESUBMISSION:** Regraded {', '.join(n.title() for n in changed)}. "
+            f"Other sections carried over from the previous grade of `{prior['Filename']}`.\n\n")
+    return note + merged, fingerprints
+
+def run_grading_job(file, model_id, prior=None, upload_once=False, local_scoring=False):
+    """Scheduler job: grade one upload and return the fields to store with its result."""
+    fields = {"Content Hash": file_content_hash(file)}
+    _job_calls.fingerprints = []
+    if prior is not None:
+        feedback, fingerprints = grade_resubmission(file, model_id, prior, local_scoring=local_scoring)
+        fields["Section Fingerprints"] = fingerprints
+    else:
+        feedback = grade_submission(file, model_id, upload_once=upload_once, local_scoring=local_scoring)
+        if file.name.lower().endswith('.docx'):
+            fields["Section Fingerprints"] = section_fingerprints(extract_text_from_docx(file), extract_images_from_docx(file))
+    fields["Feedback"] = feedback
+    fields["Recorded Calls"] = _job_calls.fingerprints
+    _job_calls.fingerprints = None
+    fields["Model"] = model_id
+    fields["Graded At"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+    return fields
+
+# --- NEW: PRE-FLIGHT PLANNER ---
+def estimate_image_tokens(data):
+    """Image tokens as the API bills them: about (width x height) / 750 after downscaling to 1568px."""
+    if Image is None:
+        return 1600
+    try:
+        with Image.open(BytesIO(data)) as img:
+            width, height = img.size
+    except Exception:
+        return 1600
+    scale = min(1.0, 1568 / max(width, height, 1))
+    return int(min(width * height * scale * scale / 750, 1600)) + 1
+
+def estimate_request_tokens(request):
+    """Local input-token estimate, used when the token counting endpoint is unavailable."""
+    tokens = len(request["system"]) / 4
+    for part in request["messages"][0]["content"]:
+        if part["type"] == "text":
+            tokens += len(part["text"]) / 4
+            continue
+        if part["source"].get("type") != "base64":
+            tokens += 1600
+            continue
+        data = base64.b64decode(part["source"]["data"])
+        if part["type"] == "image":
+            tokens += estimate_image_tokens(data)
+            continue
+        # PDFs are sent as their extracted text plus an image of every page
+        try:
+            reader = PdfReader(BytesIO(data))
+            text = "".join((page.extract_text() or "") for page in reader.pages)
+            tokens += len(text) / 4 + 1600 * len(reader.pages)
+        except Exception:
+            tokens += len(data) / 30
+    return int(tokens)
+
+def request_payload_bytes(request):
+    return sum(len(p["text"]) if p["type"] == "text" else len(p["source"].get("data", ""))
+               for p in request["messages"][0]["content"])
+
+def request_limit_issues(request, by_reference=False):
+    """
+    Reasons the API would reject this request, found before it is sent. With `by_reference` the
+    file parts go up through the Files API instead of inline, so the per-file upload limit applies
+    rather than the request size limit.
+    """
+    issues = []
+    payload = request_payload_bytes(request)
+    if payload > MAX_REQUEST_BYTES and not by_reference:
+        issues.append(f"request is {payload / 1e6:.0f} MB (limit {MAX_REQUEST_BYTES / 1e6:.0f} MB)")
+    for part in request["messages"][0]["content"]:
+        if part["type"] == "text" or part["source"].get("type") != "base64":
+            continue
+        data = base64.b64decode(part["source"]["data"])
+        if by_reference and len(data) > MAX_UPLOAD_BYTES:
+            issues.append(f"file is {len(data) / 1e6:.0f} MB (upload limit {MAX_UPLOAD_BYTES / 1e6:.0f} MB)")
+        if part["type"] == "document" and PdfReader is not None:
+            try:
+                pages = len(PdfReader(BytesIO(data)).pages)
+            except Exception as e:
+                issues.append(f"PDF could not be opened ({e})")
+                continue
+            if pages > MAX_PDF_PAGES:
+                issues.append(f"{pages} pages (limit {MAX_PDF_PAGES})")
+        elif part["type"] == "image":
+            if len(data) > MAX_IMAGE_BYTES:
+                issues.append(f"image of {len(data) / 1e6:.1f} MB (limit {MAX_IMAGE_BYTES / 1e6:.0f} MB)")
+            if Image is not None:
+                try:
+                    with Image.open(BytesIO(data)) as img:
+                        if max(img.size) > MAX_IMAGE_EDGE:
+                            issues.append(f"image of {img.size[0]}x{img.size[1]} px (limit {MAX_IMAGE_EDGE} px)")
+                except Exception:
+                    pass
+    return issues
+
+def count_request_tokens(request):
+    """Exact input tokens from the token counting endpoint (free, but rate limited)."""
+    return client.messages.count_tokens(**{k: request[k] for k in ("model", "system", "messages")}).input_tokens
+
+def model_pricing(model_id):
+    """(input, output) USD per million tokens for a model ID; unknown models are priced as Sonnet."""
+    for pattern, input_price, output_price in MODEL_PRICING:
+        if pattern in model_id:
+            return input_price, output_price
+    return next((i, o) for p, i, o in MODEL_PRICING if p == "sonnet")
+
+def preflight_files(files, model_id, local_scoring=False, cache=None, upload_once=False):
+    """
+    Measure every prepared grading request before the batch is queued: input tokens (counted by
+    the API, or estimated locally as a fallback), request-limit problems, and estimated cost.
+    Requests are measured inline; files that upload-once mode sends by reference are checked
+    against the upload limit instead. Rows are cached by content hash, so reruns do not count
+    the same report again.
+    """
+    cache = {} if cache is None else cache
+    rows, to_count = {}, []
+    for file in files:
+        key = (file_content_hash(file), model_id, local_scoring, sent_by_reference(file, upload_once))
+        if key not in cache:
+            file.seek(0, os.SEEK_END)
+            row = {"Size (MB)": round(file.tell() / 1e6, 2), "Input Tokens": 0, "Counted": "estimate", "Issues": ""}
+            file.seek(0)
+            try:
+                request = build_grade_request(build_grade_message(file)[0], model_id, local_scoring)
+                row["Issues"] = "; ".join(request_limit_issues(request, sent_by_reference(file, upload_once)))
+                row["Input Tokens"] = estimate_request_tokens(request)
+                # The counting endpoint has the same size limit: oversized inline bodies keep the estimate
+                if not row["Issues"] and request_payload_bytes(request) <= MAX_REQUEST_BYTES:
+                    to_count.append((row, request))
+            except Exception as e:
+                row["Issues"] = f"could not be prepared ({e})"
+            cache[key] = row
+        rows[file.name] = cache[key]
+
+    # Exact counts where the endpoint answers; the local estimate stays for the rest
+    if to_count:
+        api_down = threading.Event()
+        def count(item):
+            row, request = item
+            if api_down.is_set():
+                return
+            try:
+                row["Input Tokens"] = count_request_tokens(request)
+                row["Counted"] = "API"
+            except Exception as e:
+                if not api_down.is_set():
+                    print(f"Token counting unavailable, using local estimates: {e}")
+                api_down.set()
+        with ThreadPoolExecutor(max_workers=min(8, len(to_count))) as pool:
+            list(pool.map(count, to_count))
+
+    input_price, output_price = model_pricing(model_id)
+    output_tokens = OUTPUT_TOKENS_ESTIMATE // 2 if local_scoring else OUTPUT_TOKENS_ESTIMATE
+    plan = []
+    for file in files:
+        row = dict(rows[file.name], Filename=file.name)
+        row["Est. Cost ($)"] = round((row["Input Tokens"] * input_price + output_tokens * output_price) / 1e6, 4)
+        plan.append(row)
+    return plan
+
+def preflight_summary(plan):
+    """Totals for the reports that will be sent, and wall time at the configured concurrency."""
+    sendable = [row for row in plan if not row["Issues"]]
+    per_report = get_latency_tracker().percentile(50) or DEFAULT_GRADE_SECONDS
+    waves = -(-len(sendable) // MAX_CONCURRENT_GRADES)
+    return {
+        "reports": len(sendable),
+        "flagged": len(plan) - len(sendable),
+        "input_tokens": sum(row["Input Tokens"] for row in sendable),
+        "cost": sum(row["Est. Cost ($)"] for row in sendable),
+        "eta_seconds": max(waves * per_report, len(sendable) * GRADE_DISPATCH_INTERVAL),
+    }
 
 # --- PARSE SCORE FUNCTION ---
 def parse_score(text):
@@ -663,112 +2125,633 @@ def parse_score(text):
         print(f"Error parsing score: {e}")
     return "N/A"
 
+# --- SHARED GRADING SCHEDULER (ONE PER SERVER PROCESS) ---
+class GradingBatch:
+    """
+    One session's upload, queued on the shared scheduler. Each finished job is handed to `sink`
+    (saved by the worker itself) and then announced on `results` for the page to display.
+    """
+    def __init__(self, user_id, jobs, retry_round=0, sink=None):
+        self.batch_id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.pending = deque(jobs)  # (key, fn, args) tuples
+        self.jobs = {job[0]: job for job in jobs}  # kept so failed jobs can be resubmitted
+        self.retry_round = retry_round
+        self.sink = sink
+        self.total = len(jobs)
+        self.interactive = self.total <= INTERACTIVE_BATCH_SIZE
+        self.results = queue.Queue()
+        self.running = 0
+        self.finished = 0
+        self.submitted_at = time.monotonic()
+        self.last_seen = self.submitted_at  # last time a page was following this batch
+
+    @property
+    def done(self):
+        return not self.pending and self.running == 0
+
+
+class GradingScheduler:
+    """
+    Process-global work queue shared by every Streamlit session.
+    - Global cap: never more than `max_concurrency` API calls in flight for the whole deployment,
+      hedged duplicates included (they borrow a free slot and hold it until they finish).
+    - Priority: small interactive batches are dispatched before bulk uploads.
+    - Fair share: the teacher with the fewest grades in flight gets the next free slot,
+      so one 200-report upload cannot starve everyone else.
+    """
+    def __init__(self, max_concurrency, dispatch_interval=0.0):
+        self.max_concurrency = max_concurrency
+        self.dispatch_interval = dispatch_interval
+        self._cond = threading.Condition()
+        self._batches = []
+        self._running_by_user = defaultdict(int)
+        self._last_served = {}
+        self._next_dispatch_at = 0.0
+        self._hedges_running = 0
+        for n in range(max_concurrency):
+            threading.Thread(target=self._worker, name=f"grader-{n}", daemon=True).start()
+
+    def submit(self, user_id, jobs, retry_round=0, sink=None):
+        batch = GradingBatch(user_id, jobs, retry_round, sink)
+        with self._cond:
+            if batch.pending:
+                self._batches.append(batch)
+            self._cond.notify_all()
+        return batch
+
+    def cancel(self, batch):
+        """Drop a batch's queued jobs. Grades already in flight still report back."""
+        with self._cond:
+            self._drop_pending(batch)
+
+    def _drop_pending(self, batch):
+        batch.finished += len(batch.pending)
+        batch.pending.clear()
+        self._forget_if_done(batch)
+
+    def stats(self):
+        with self._cond:
+            queued = sum(len(b.pending) for b in self._batches)
+            running = sum(b.running for b in self._batches)
+            users = len({b.user_id for b in self._batches})
+        return {"queued": queued, "running": running, "users": users}
+
+    def _in_flight(self):
+        return sum(self._running_by_user.values()) + self._hedges_running
+
+    def try_hedge_slot(self):
+        """Claim a slot for a hedged duplicate; False if the deployment is at its cap or a call is not yet due."""
+        with self._cond:
+            now = time.monotonic()
+            if self._in_flight() >= self.max_concurrency or now < self._next_dispatch_at:
+                return False
+            self._hedges_running += 1
+            self._next_dispatch_at = now + self.dispatch_interval
+            return True
+
+    def release_hedge_slot(self):
+        with self._cond:
+            self._hedges_running -= 1
+            self._cond.notify_all()
+
+    def _forget_if_done(self, batch):
+        if batch.done and batch in self._batches:
+            self._batches.remove(batch)
+
+    def _next_job(self):
+        now = time.monotonic()
+        for b in list(self._batches):
+            if b.pending and now - b.last_seen > BATCH_ABANDON_SECONDS:
+                # The page that started it was closed: nobody would see these grades arrive
+                print(f"🛑 Batch {b.batch_id[:8]} has not been followed for {BATCH_ABANDON_SECONDS}s; "
+                      f"dropping its {len(b.pending)} queued job(s).")
+                self._drop_pending(b)
+        candidates = [b for b in self._batches if b.pending]
+        if not candidates or self._in_flight() >= self.max_concurrency:
+            # Hedges hold slots too; workers wait for release_hedge_slot() to free one
+            return None
+        pool = [b for b in candidates if b.interactive] or candidates
+        batch = min(pool, key=lambda b: (
+            self._running_by_user[b.user_id],
+            self._last_served.get(b.user_id, 0.0),
+            b.submitted_at,
+        ))
+        return batch, batch.pending.popleft()
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                picked = self._next_job()
+                while picked is None:
+                    self._cond.wait()
+                    picked = self._next_job()
+                batch, (key, fn, args) = picked
+                batch.running += 1
+                self._running_by_user[batch.user_id] += 1
+                now = time.monotonic()
+                self._last_served[batch.user_id] = now
+                # Space out API calls globally instead of each session sleeping on its own
+                start_at = max(now, self._next_dispatch_at)
+                self._next_dispatch_at = start_at + self.dispatch_interval
+
+            if start_at > now:
+                time.sleep(start_at - now)
+            try:
+                outcome = ("ok", fn(*args), None)
+            except Exception as e:
+                outcome = ("error", e, None)
+            if batch.sink is not None:
+                # Saved here rather than by the page, so a grade survives its tab being closed
+                try:
+                    outcome = batch.sink.deliver((key, fn, args), *outcome[:2])
+                except Exception as e:
+                    print(f"⚠️ Could not save the grade for {key}: {e}")
+                    outcome = ("error", e, None)
+
+            # Publish before marking finished so a session never sees `done` with a result still in flight
+            batch.results.put((key,) + outcome)
+            with self._cond:
+                batch.running -= 1
+                batch.finished += 1
+                self._running_by_user[batch.user_id] -= 1
+                self._forget_if_done(batch)
+                self._cond.notify_all()
+
+
+@st.cache_resource
+def get_grading_scheduler():
+    return GradingScheduler(MAX_CONCURRENT_GRADES, GRADE_DISPATCH_INTERVAL)
+
+# --- NEAR-DUPLICATE DETECTION (MINHASH + LSH, SHARED ACROSS SESSIONS) ---
+class NearDuplicateIndex:
+    """
+    MinHash signatures of 5-word shingles, banded into LSH buckets so a new report is
+    only compared against reports that share at least one bucket (no pairwise scan).
+    Signatures are appended to a JSONL file so the index survives restarts. The index is
+    shared by the whole deployment, so each entry records its owner (the teacher).
+    """
+    SHINGLE_WORDS = 5
+    NUM_PERM = 128
+    BANDS = 16  # 16 bands x 8 rows: P(candidate) = 1-(1-s^8)^16: ~61% at 0.7 similarity, ~95% at 0.8, >99.9% at 0.9
+    MIN_SHINGLES = 30  # too little text to judge (e.g. report pasted as images)
+    _PRIME = (1 << 31) - 1
+
+    def __init__(self, path, threshold=DUPLICATE_SIMILARITY_THRESHOLD):
+        self.path = path
+        self.threshold = threshold
+        self.rows = self.NUM_PERM // self.BANDS
+        rng = np.random.default_rng(20240917)  # fixed seed: signatures must stay comparable across restarts
+        self._a = rng.integers(1, self._PRIME, self.NUM_PERM, dtype=np.uint64)
+        self._b = rng.integers(0, self._PRIME, self.NUM_PERM, dtype=np.uint64)
+        self._lock = threading.Lock()
+        self._docs = {}
+        self._buckets = [defaultdict(set) for _ in range(self.BANDS)]
+        self._load()
+
+    def signature(self, text):
+        """MinHash signature of the text, or None if there is too little text to compare."""
+        text = re.sub(r'</?su[bp]>', '', text.lower())
+        words = re.findall(r'[a-z0-9]+', text)
+        k = self.SHINGLE_WORDS
+        shingles = {" ".join(words[i:i + k]) for i in range(len(words) - k + 1)}
+        if len(shingles) < self.MIN_SHINGLES:
+            return None
+        hashes = np.fromiter((zlib.crc32(sh.encode('utf-8')) for sh in shingles), dtype=np.uint64, count=len(shingles))
+        hashes %= self._PRIME
+        # One universal hash per permutation, vectorised over every shingle
+        permuted = (self._a[:, None] * hashes[None, :] + self._b[:, None]) % self._PRIME
+        return permuted.min(axis=1)
+
+    def _band_keys(self, sig):
+        r = self.rows
+        return [sig[i * r:(i + 1) * r].tobytes() for i in range(self.BANDS)]
+
+    def query(self, sig, exclude=None):
+        """Indexed documents whose estimated similarity to `sig` meets the threshold, best first."""
+        with self._lock:
+            candidates = set()
+            for band, key in enumerate(self._band_keys(sig)):
+                candidates |= self._buckets[band].get(key, set())
+            candidates.discard(exclude)
+            matches = []
+            for doc_id in candidates:
+                doc = self._docs[doc_id]
+                similarity = float(np.mean(doc["sig"] == sig))
+                if similarity >= self.threshold:
+                    matches.append({"doc_id": doc_id, "label": doc["label"], "session": doc["session"],
+                                    "owner": doc["owner"], "similarity": similarity})
+        return sorted(matches, key=lambda m: -m["similarity"])
+
+    def add(self, doc_id, label, session, sig, owner=None, persist=True):
+        with self._lock:
+            if doc_id in self._docs:
+                return
+            self._docs[doc_id] = {"label": label, "session": session, "owner": owner, "sig": sig}
+            for band, key in enumerate(self._band_keys(sig)):
+                self._buckets[band][key].add(doc_id)
+        if persist:
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps({"doc_id": doc_id, "label": label, "session": session, "owner": owner,
+                                        "sig": sig.tolist()}) + "\n")
+            except Exception as e:
+                print(f"Could not persist duplicate index entry for {label}: {e}")
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    rec = json.loads(line)
+                    self.add(rec["doc_id"], rec["label"], rec["session"], np.array(rec["sig"], dtype=np.uint64),
+                             owner=rec.get("owner"), persist=False)
+        except Exception as e:
+            print(f"Could not load duplicate index: {e}")
+
+
+@st.cache_resource
+def get_duplicate_index():
+    return NearDuplicateIndex(os.path.join(AUTOSAVE_ROOT, "near_duplicate_index.jsonl"))
+
+def find_near_duplicates(files, session_name, owner):
+    """
+    Index this upload and group near-duplicate reports into clusters.
+    Returns a list of {"members": [filenames in this upload], "prior": [earlier matches], "similarity": max}.
+    Earlier matches from other teachers keep only their similarity: no student filename or session name.
+    """
+    index = get_duplicate_index()
+    cache = st.session_state.minhash_cache
+    parent = {}
+
+    def find(x):
+        while parent.setdefault(x, x) != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    doc_ids = {}
+    for file in files:
+        doc_id = f"{file_content_hash(file)[:20]}/{file.name}"
+        doc_ids[doc_id] = file.name
+        if doc_id not in cache:
+            cache[doc_id] = index.signature(get_submission_text(file))
+    
+    best = defaultdict(float)
+    prior = defaultdict(list)
+    for doc_id, filename in doc_ids.items():
+        sig = cache[doc_id]
+        if sig is None:
+            continue
+        for match in index.query(sig, exclude=doc_id):
+            other = doc_ids.get(match["doc_id"])
+            if other is not None:
+                parent[find(filename)] = find(other)
+            elif match["owner"] == owner:
+                prior[filename].append(match)
+            else:
+                prior[filename].append({"label": None, "session": None, "similarity": match["similarity"]})
+            best[filename] = max(best[filename], match["similarity"])
+        index.add(doc_id, filename, session_name, sig, owner=owner)
+
+    clusters = defaultdict(list)
+    for filename in doc_ids.values():
+        if best[filename] > 0:
+            clusters[find(filename)].append(filename)
+    result = []
+    for members in clusters.values():
+        result.append({
+            "members": members,
+            "prior": [m for name in members for m in prior[name]],
+            "similarity": max(best[name] for name in members),
+        })
+    return result
+
 # # --- WORD FORMATTER (Upgraded for Sub/Superscripts) ---
-def write_markdown_to_docx(doc, text):
+# Inline markup we understand: **bold**, <sup>..</sup>, <sub>..</sub> (nesting allowed)
+MARKDOWN_TOKEN_RE = re.compile(r"(\*\*|</?sup>|</?sub>)")
+HORIZONTAL_RULE = "_" * 50
+_XML_INVALID_CHARS_RE = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")  # Word cannot store these
+
+def parse_markdown_line(content):
     """
-    Parses Markdown text and writes it to a docx Document.
-    Handles headers, bullet points, bold (**text**), 
-    superscript (<sup>text</sup>), and subscript (<sub>text</sub>).
+    Split one line into runs of (text, bold, vert_align) where vert_align is None,
+    'superscript' or 'subscript'. Bold can wrap sub/superscripts (**H<sub>2</sub>O**);
+    markers without a partner are kept as literal text.
     """
-    lines = text.split('\n')
-    for line in lines:
+    tokens = MARKDOWN_TOKEN_RE.split(content)
+    bold_markers = [i for i in range(1, len(tokens), 2) if tokens[i] == '**']
+    if len(bold_markers) % 2:
+        tokens[bold_markers[-1]] = '\x00**'  # unpaired: literal
+    runs = []
+    bold = False
+    vert = None
+    for i, token in enumerate(tokens):
+        if not token:
+            continue
+        if i % 2 and token == '**':
+            bold = not bold
+            continue
+        if i % 2 and token[0] == '<':
+            tag = token.strip('</>')
+            align = 'superscript' if tag == 'sup' else 'subscript'
+            if not token.startswith('</') and f'</{tag}>' in tokens[i + 1:]:
+                vert = align
+                continue
+            if token.startswith('</') and vert == align:
+                vert = None
+                continue
+        text = token.replace('\x00', '')
+        if runs and runs[-1][1] == bold and runs[-1][2] == vert:
+            runs[-1] = (runs[-1][0] + text, bold, vert)
+        else:
+            runs.append((text, bold, vert))
+    return runs
+
+def parse_markdown_blocks(text):
+    """Turn feedback Markdown into (style, runs) paragraphs; style is None, 'List Bullet' or 'Heading N'."""
+    blocks = []
+    # The deduction-codes comment is for the app (scores, analytics), not for students
+    text = DEDUCTION_CODES_COMMENT_RE.sub('', text)
+    for line in _XML_INVALID_CHARS_RE.sub('', text).split('\n'):
         line = line.strip()
         if not line:
             continue 
         
         # 1. Handle Headers
         if line.startswith('# '): 
-            doc.add_heading(line.replace('# ', '').replace('*', '').strip(), level=2) 
-            continue
-        if line.startswith('### '):
-            doc.add_heading(line.replace('### ', '').replace('*', '').strip(), level=3)
-            continue
-        if line.startswith('## '): 
-            doc.add_heading(line.replace('## ', '').replace('*', '').strip(), level=2)
-            continue
-        if line.startswith('---') or line.startswith('___'):
-            doc.add_paragraph("_" * 50) # visual separator
-            continue
-
+            blocks.append(("Heading 2", parse_markdown_line(line.replace('# ', '').replace('*', '').strip())))
+        elif line.startswith('### '):
+            blocks.append(("Heading 3", parse_markdown_line(line.replace('### ', '').replace('*', '').strip())))
+        elif line.startswith('## '): 
+            blocks.append(("Heading 2", parse_markdown_line(line.replace('## ', '').replace('*', '').strip())))
+        elif line.startswith('---') or line.startswith('___'):
+            blocks.append((None, [(HORIZONTAL_RULE, False, None)])) # visual separator
         # 2. Handle List Items
-        if line.startswith('* ') or line.startswith('- '):
-            p = doc.add_paragraph(style='List Bullet')
-            content = line[2:] 
+        elif line.startswith('* ') or line.startswith('- '):
+            blocks.append(("List Bullet", parse_markdown_line(line[2:])))
         else:
-            p = doc.add_paragraph()
-            content = line
+            blocks.append((None, parse_markdown_line(line)))
+    return blocks
 
-        # 3. Handle Formatting Tags (Bold, Sup, Sub)
-        # This regex splits the text by tags so we can process each chunk
-        # It looks for **bold**, <sup>sup</sup>, and <sub>sub</sub>
-        parts = re.split(r'(\*\*.*?\*\*|<sup>.*?</sup>|<sub>.*?</sub>)', content)
-        
-        for part in parts:
-            if not part: continue # Skip empty splits
-            
-            run = p.add_run()
-            
-            # Handle Bold
-            if part.startswith('**') and part.endswith('**'):
-                run.text = part[2:-2].replace('<sub>', '').replace('</sub>', '').replace('<sup>', '').replace('</sup>', '')
+def write_markdown_to_docx(doc, text):
+    """
+    Parses Markdown text and writes it to a docx Document.
+    Handles headers, bullet points, bold (**text**), 
+    superscript (<sup>text</sup>), and subscript (<sub>text</sub>).
+    """
+    for style, runs in parse_markdown_blocks(text):
+        p = doc.add_paragraph(style=style)
+        # 3. Handle Formatting (Bold, Sup, Sub)
+        for text_part, bold, vert in runs:
+            run = p.add_run(text_part)
+            if bold:
                 run.bold = True
-            
-            # Handle Superscript (Exponents)
-            elif part.startswith('<sup>') and part.endswith('</sup>'):
-                run.text = part[5:-6]
+            if vert == 'superscript':
                 run.font.superscript = True
-                
-            # Handle Subscript (Chemical Formulas)
-            elif part.startswith('<sub>') and part.endswith('</sub>'):
-                run.text = part[5:-6]
+            elif vert == 'subscript':
                 run.font.subscript = True
-                
-            # Regular Text
-            else:
-                run.text = part
 
+# --- FAST DOCX RENDERER (TEMPLATE CLONING) ---
+PAGE_BREAK_XML = '<w:p><w:r><w:br w:type="page"/></w:r></w:p>'
 
-def create_master_doc(results, session_name):
-    doc = Document()
+class DocxRenderer:
+    """
+    Renders feedback straight to WordprocessingML, skipping python-docx's object layer.
+    The default template is loaded once; each report clones its zip (every part except
+    word/document.xml is copied byte-for-byte) and appends a freshly written document.xml.
+    Output matches write_markdown_to_docx() on a new Document().
+    """
+    DOCUMENT_PART = "word/document.xml"
+
+    def __init__(self):
+        template = Document()
+        self.style_ids = {
+            name: template.styles[name].style_id for name in ("Heading 2", "Heading 3", "List Bullet")
+        }
+        package = BytesIO()
+        template.save(package)
+        with zipfile.ZipFile(package) as src:
+            document_xml = src.read(self.DOCUMENT_PART).decode('utf-8')
+            shell = BytesIO()
+            with zipfile.ZipFile(shell, 'w', zipfile.ZIP_DEFLATED) as dst:
+                for info in src.infolist():
+                    if info.filename != self.DOCUMENT_PART:
+                        dst.writestr(info, src.read(info.filename))
+        self._shell = shell.getvalue()
+        # document.xml = prefix + <paragraphs> + section properties + suffix
+        body_start = document_xml.index('<w:body>') + len('<w:body>')
+        sect_start = document_xml.index('<w:sectPr', body_start)
+        self._prefix = document_xml[:body_start]
+        self._suffix = document_xml[sect_start:]
+
+    @staticmethod
+    def _run_xml(text, bold, vert):
+        text = text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+        text = text.replace('\t', '</w:t><w:tab/><w:t xml:space="preserve">')
+        props = ('<w:b/>' if bold else '') + (f'<w:vertAlign w:val="{vert}"/>' if vert else '')
+        props = f'<w:rPr>{props}</w:rPr>' if props else ''
+        return f'<w:r>{props}<w:t xml:space="preserve">{text}</w:t></w:r>'
+
+    def body_xml(self, feedback):
+        """Paragraph XML for one feedback text (no section properties)."""
+        parts = []
+        for style, runs in parse_markdown_blocks(feedback):
+            parts.append('<w:p>')
+            if style:
+                parts.append(f'<w:pPr><w:pStyle w:val="{self.style_ids[style]}"/></w:pPr>')
+            parts.extend(self._run_xml(*run) for run in runs)
+            parts.append('</w:p>')
+        return ''.join(parts)
+
+    def write(self, out, body_parts):
+        """
+        Write a .docx to the empty binary file `out`. `body_parts` may be a generator:
+        document.xml is streamed into the zip one part at a time, never joined in memory.
+        """
+        out.write(self._shell)
+        with zipfile.ZipFile(out, 'a', zipfile.ZIP_DEFLATED) as z:
+            with z.open(self.DOCUMENT_PART, 'w', force_zip64=True) as part:
+                part.write(self._prefix.encode('utf-8'))
+                for body in body_parts:
+                    part.write(body.encode('utf-8'))
+                part.write(self._suffix.encode('utf-8'))
+
+    def package(self, body_parts):
+        """Wrap paragraph XML in the cloned template and return .docx bytes."""
+        out = BytesIO()
+        self.write(out, body_parts)
+        return out.getvalue()
+
+    def render(self, feedback):
+        return self.package([self.body_xml(feedback)])
+
+
+@st.cache_resource
+def get_docx_renderer():
+    return DocxRenderer()
+
+def benchmark_renderers(feedbacks, n=1000):
+    """Per-report render time of the python-docx path vs. the template-cloning renderer."""
+    renderer = get_docx_renderer()
+    sample = [feedbacks[i % len(feedbacks)] for i in range(n)]
+
+    def legacy(feedback):
+        doc = Document()
+        write_markdown_to_docx(doc, feedback)
+        doc.save(BytesIO())
+
+    rows = []
+    for label, render in (("python-docx (Document per report)", legacy), ("Template clone", renderer.render)):
+        timings = []
+        for feedback in sample:
+            t0 = time.perf_counter()
+            render(feedback)
+            timings.append((time.perf_counter() - t0) * 1000)
+        timings = np.array(timings)
+        rows.append({
+            "Renderer": label,
+            "Reports": n,
+            "Mean (ms)": round(float(timings.mean()), 2),
+            "p50 (ms)": round(float(np.percentile(timings, 50)), 2),
+            "p95 (ms)": round(float(np.percentile(timings, 95)), 2),
+            "Total (s)": round(float(timings.sum()) / 1000, 2),
+        })
+    df = pd.DataFrame(rows)
+    df["Speedup"] = (df["Mean (ms)"].iloc[0] / df["Mean (ms)"]).round(1)
+    return df
+
+# --- EXPORTS: STREAMED INTO THE MASTER DOC AND ZIP ---
+_export_read_lock = threading.Lock()
+
+def build_exports(results, session_name):
+    """
+    Render each student once and stream it into both exports:
+    the master .docx (all students, page breaks between) and the per-student .zip bundle.
+    Returns two spooled files (in RAM while small, on disk past EXPORT_SPOOL_BYTES), rewound;
+    only one student's rendered .docx is held in memory at a time.
+    """
+    renderer = get_docx_renderer()
+    master = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES)
+    bundle = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES)
     # REMOVED SESSION HEADER
-    # doc.add_heading(f"Lab Report Grades: {session_name}", 0) 
-    for item in results:
-        # REMOVED FILENAME HEADER (Starts with Score + Student Name)
-        write_markdown_to_docx(doc, item['Feedback'])
-        doc.add_page_break()
-    bio = BytesIO()
-    doc.save(bio)
-    return bio.getvalue()
+
+    # .docx files are already zip-compressed: store them instead of deflating them again
+    with zipfile.ZipFile(bundle, 'w', zipfile.ZIP_STORED) as z:
+        def master_parts():
+            for item in results:
+                body = renderer.body_xml(item['Feedback'])
+                safe_name = os.path.splitext(item['Filename'])[0] + "_Feedback.docx"
+                z.writestr(safe_name, renderer.package([body]))
+
+                # REMOVED FILENAME HEADER (Starts with Score + Student Name)
+                yield body
+                yield PAGE_BREAK_XML
+
+        renderer.write(master, master_parts())
+
+    master.seek(0)
+    bundle.seek(0)
+    return master, bundle
+
+def read_export(spool):
+    """Contents of a spooled export, read when its download button is clicked."""
+    with _export_read_lock:
+        spool.seek(0)
+        return spool.read()
+
+def create_master_doc(results, session_name):
+    master, bundle = build_exports(results, session_name)
+    bundle.close()
+    with master:
+        return master.read()
 
 def create_zip_bundle(results):
-    zip_buffer = BytesIO()
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as z:
-        for item in results:
-            doc = Document()
-            # REMOVED FEEDBACK HEADER
-            write_markdown_to_docx(doc, item['Feedback'])
-            doc_buffer = BytesIO()
-            doc.save(doc_buffer)
-            safe_name = os.path.splitext(item['Filename'])[0] + "_Feedback.docx"
-            z.writestr(safe_name, doc_buffer.getvalue())
-    return zip_buffer.getvalue()
+    master, bundle = build_exports(results, None)
+    master.close()
+    with bundle:
+        return bundle.read()
+
+def get_cached_exports(results, session_name):
+    """
+    Export files for the current results, rebuilt only when the results change (not on every rerun).
+    Session state keeps the spooled file handles, never the bytes.
+    """
+    signature = hashlib.sha256(json.dumps(
+        [session_name] + [[item['Filename'], item['Feedback']] for item in results]
+    ).encode('utf-8')).hexdigest()
+    cached = st.session_state.get('export_cache')
+    if not cached or cached[0] != signature:
+        if cached:
+            for spool in cached[1:]:
+                spool.close()
+        cached = (signature,) + build_exports(results, session_name)
+        st.session_state.export_cache = cached
+    return cached[1], cached[2]
 
 # --- NEW: AUTOSAVE INDIVIDUAL REPORT ---
+# --- NEW: CONCURRENCY-SAFE FILE WRITES ---
+_process_locks = defaultdict(threading.Lock)
+
+class FileLock:
+    """
+    Exclusive lock on `<path>.lock`, held across processes and replicas via flock (POSIX).
+    Without fcntl (Windows) it falls back to a lock that only covers this process.
+    """
+    def __init__(self, path):
+        self.path = path + ".lock"
+        self.handle = None
+
+    def __enter__(self):
+        if fcntl is None:
+            _process_locks[self.path].acquire()
+            return self
+        self.handle = open(self.path, 'a')
+        fcntl.flock(self.handle, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if fcntl is None:
+            _process_locks[self.path].release()
+            return False
+        fcntl.flock(self.handle, fcntl.LOCK_UN)
+        self.handle.close()
+        return False
+
+def atomic_write(path, data):
+    """Write bytes via a temp file in the same folder and rename it over `path`, so readers never see a partial file."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-", suffix=os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def feedback_doc_name(filename, taken):
+    """'<name>_Feedback.docx', with a short hash when another report in the folder already uses that name."""
+    stem = re.sub(r'[\\/:*?"<>|]+', '_', os.path.splitext(filename)[0]).strip() or "report"
+    if stem.lower() in taken:
+        stem += "_" + hashlib.sha1(filename.encode('utf-8')).hexdigest()[:6]
+    return stem + "_Feedback.docx"
+
 def autosave_report(item, autosave_dir):
-    """Save individual report as Word doc and append to CSV immediately after grading."""
+    """
+    Save individual report as Word doc and upsert its gradebook row immediately after grading.
+    The gradebook is updated under a file lock and every file is replaced atomically.
+    """
     try:
         # --- FIX: FORCE FOLDER CREATION ---
-        if not os.path.exists(autosave_dir):
-            os.makedirs(autosave_dir)
+        os.makedirs(autosave_dir, exist_ok=True)
         # ----------------------------------
-        # 1. Save Word Document
-        doc = Document()
-        write_markdown_to_docx(doc, item['Feedback'])
-        safe_filename = os.path.splitext(item['Filename'])[0] + "_Feedback.docx"
-        doc_path = os.path.join(autosave_dir, safe_filename)
-        doc.save(doc_path)
-        
-        # 2. Append to CSV (or create if doesn't exist)
         csv_path = os.path.join(autosave_dir, "gradebook.csv")
         
         # Parse feedback into row data
@@ -778,23 +2761,407 @@ def autosave_report(item, autosave_dir):
         }
         feedback_data = parse_feedback_for_csv(item['Feedback'])
         row_data.update(feedback_data)
-        
-        # Check if CSV exists
-        if os.path.exists(csv_path):
-            existing_df = pd.read_csv(csv_path)
-            # Remove duplicate if re-grading same file
-            existing_df = existing_df[existing_df['Filename'] != item['Filename']]
-            new_df = pd.concat([existing_df, pd.DataFrame([row_data])], ignore_index=True)
-        else:
-            new_df = pd.DataFrame([row_data])
-        
-        new_df.to_csv(csv_path, index=False, encoding='utf-8-sig')
+        docx_bytes = get_docx_renderer().render(item['Feedback'])
+
+        with FileLock(csv_path):
+            existing_df = pd.read_csv(csv_path) if os.path.exists(csv_path) else pd.DataFrame(columns=["Filename"])
+            filenames = [str(f) for f in existing_df['Filename']]
+            # Re-grading the same file replaces its row in place; a new file is appended
+            position = filenames.index(item['Filename']) if item['Filename'] in filenames else len(filenames)
+
+            # 1. Save Word Document (earlier rows keep the plain name if two reports share a stem)
+            taken = {os.path.splitext(f)[0].lower() for f in filenames[:position]}
+            doc_path = os.path.join(autosave_dir, feedback_doc_name(item['Filename'], taken))
+            atomic_write(doc_path, docx_bytes)
+
+            # 2. Upsert the gradebook row
+            new_df = pd.concat([existing_df.iloc[:position], pd.DataFrame([row_data]), existing_df.iloc[position + 1:]],
+                               ignore_index=True)
+            atomic_write(csv_path, new_df.to_csv(index=False).encode('utf-8-sig'))
         
         return True
     except Exception as e:
         print(f"Autosave failed for {item['Filename']}: {e}")
         return False
     
+# --- CLASS ANALYTICS: TYPED SCORE STORE ---
+SECTION_SCORE_COLUMNS = [f"{name.title()} Score" for name in RUBRIC_SECTIONS]  # same names as the CSV export
+SECTION_SCORE_RE = re.compile(
+    r"^[#* \t]*(?:10|[1-9])\.\s+(" + "|".join(RUBRIC_SECTIONS) + r")\b[^\n]*?:\s*\**\s*([\d.]+)\s*/\s*10", re.M
+)
+# "(-0.5 pts)", "(-1 pt)", "(-2.0)" as written in the Improvements bullets
+DEDUCTION_RE = re.compile(r"\(\s*-\s*(\d+(?:\.\d+)?)\s*(?:pts?|points?)?\.?\s*\)", re.I)
+
+def extract_section_scores(feedback):
+    """Float score per rubric section (NaN where the section was not found)."""
+    scores = dict.fromkeys(SECTION_SCORE_COLUMNS, np.nan)
+    for name, value in SECTION_SCORE_RE.findall(feedback):
+        try:
+            scores[f"{name.title()} Score"] = float(value)
+        except ValueError:
+            pass
+    return scores
+
+def extract_deductions(feedback):
+    """(section, reason, points) for every explicit deduction in the feedback text."""
+    codes = parse_deduction_codes(feedback)
+    if codes is not None:
+        # Locally scored reports carry exact deduction codes; prefer them over scraping the prose
+        applied, reference_level = applied_deductions(codes)
+        deductions = [(section.title(), description.lower(), points)
+                      for section, groups in applied.items() for _, description, points in groups.values()]
+        if reference_level not in (None, "REF-3"):
+            score, description = REFERENCE_LEVELS[reference_level]
+            deductions.append(("References", description.lower(), 10.0 - max(score, REFERENCES_FLOOR if score else 0.0)))
+        return deductions
+    deductions = []
+    for name, (start, end) in feedback_section_blocks(feedback).items():
+        block = feedback[start:end]
+        for match in DEDUCTION_RE.finditer(block):
+            # The reason is the clause just before the "(-x pts)" marker
+            before = re.sub(r'[*#_`"“”]|</?su[bp]>', '', block[:match.start()])
+            clause = re.split(r'[.!?:\n]\s', before.strip())[-1]
+            reason = re.sub(r'\s+', ' ', re.sub(r'\d+', '#', clause)).strip(' -,;').lower()[:80]
+            deductions.append((name.title(), reason or "(unspecified)", float(match.group(1))))
+    return deductions
+
+class ScoreStore:
+    """
+    Columnar store of every graded report across this teacher's sessions: float section
+    scores plus filename, session, model and timestamp, and a long table of deductions.
+    Rows are appended as results arrive and folded into typed DataFrames lazily, so the
+    analytics below stay vectorised even over tens of thousands of reports. Rows are keyed
+    by session ID, so saving a session under a name renames its rows instead of copying them.
+    """
+    KEY = ["Session ID", "Filename"]
+
+    def __init__(self):
+        self.lock = threading.Lock()  # grading workers add rows while the page reads them
+        self._reports = self._empty_reports()
+        self._deductions = self._empty_deductions()
+        self._pending_reports = []
+        self._pending_deductions = []
+        self._next_id = 0
+
+    @staticmethod
+    def _empty_reports():
+        columns = ["Report ID", "Filename", "Session ID", "Session", "Model", "Graded At", "Total Score"] + SECTION_SCORE_COLUMNS
+        return pd.DataFrame(columns=columns).pipe(ScoreStore._typed)
+
+    @staticmethod
+    def _empty_deductions():
+        return pd.DataFrame({
+            "Report ID": pd.Series(dtype="int64"), "Section": pd.Series(dtype="category"),
+            "Reason": pd.Series(dtype="string"), "Points": pd.Series(dtype="float64"),
+        })
+
+    @staticmethod
+    def _typed(df):
+        return df.astype({
+            "Report ID": "int64", "Filename": "string", "Session ID": "string", "Session": "category", "Model": "category",
+            "Total Score": "float64", **{c: "float64" for c in SECTION_SCORE_COLUMNS},
+        }).assign(**{"Graded At": pd.to_datetime(df["Graded At"], errors="coerce")})
+
+    def add(self, item, session_id, session):
+        """Record one graded result (a later grade of the same file in the same session replaces it)."""
+        with self.lock:
+            self._add(item, session_id, session)
+
+    def _add(self, item, session_id, session):
+        feedback = item.get('Feedback', '')
+        if is_failed_grade(item):
+            return
+        report_id = self._next_id
+        self._next_id += 1
+        try:
+            total = float(item.get('Score'))
+        except (TypeError, ValueError):
+            total = np.nan
+        self._pending_reports.append({
+            "Report ID": report_id, "Filename": item['Filename'], "Session ID": session_id, "Session": session,
+            "Model": item.get('Model', 'unknown'), "Graded At": item.get('Graded At'),
+            "Total Score": total, **extract_section_scores(feedback),
+        })
+        self._pending_deductions.extend(
+            {"Report ID": report_id, "Section": section, "Reason": reason, "Points": points}
+            for section, reason, points in extract_deductions(feedback)
+        )
+
+    def add_session(self, results, session_id, session):
+        with self.lock:
+            for item in results:
+                self._add(item, session_id, session)
+
+    def drop_session(self, session_id):
+        with self.lock:
+            self._flush()
+            self._reports = self._reports[self._reports["Session ID"] != session_id]
+            self._reports["Session"] = self._reports["Session"].cat.remove_unused_categories()
+            self._deductions = self._deductions[self._deductions["Report ID"].isin(self._reports["Report ID"])]
+
+    def rename_session(self, session_id, session):
+        with self.lock:
+            self._flush()
+            names = self._reports["Session"].astype("object")
+            names[self._reports["Session ID"] == session_id] = session
+            self._reports["Session"] = names.astype("category")
+
+    def _flush(self):
+        if self._pending_reports:
+            new = self._typed(pd.DataFrame(self._pending_reports))
+            combined = pd.concat([self._reports.astype({"Session": "object", "Model": "object"}),
+                                  new.astype({"Session": "object", "Model": "object"})], ignore_index=True)
+            combined = combined.drop_duplicates(self.KEY, keep="last")
+            self._reports = combined.astype({"Session": "category", "Model": "category"}).reset_index(drop=True)
+            self._pending_reports = []
+        if self._pending_deductions:
+            new = pd.DataFrame(self._pending_deductions).astype({"Reason": "string"})
+            self._deductions = pd.concat([self._deductions.astype({"Section": "object"}), new], ignore_index=True)
+            self._pending_deductions = []
+        # Deductions of replaced reports go with them
+        live = self._deductions["Report ID"].isin(self._reports["Report ID"])
+        if not live.all():
+            self._deductions = self._deductions[live]
+        self._deductions = self._deductions.astype({"Section": "category"})
+
+    def reports(self):
+        with self.lock:
+            self._flush()
+            return self._reports
+
+    def deductions(self):
+        with self.lock:
+            self._flush()
+            return self._deductions
+
+def get_score_store():
+    """This teacher's score store, seeded from every saved session on first use."""
+    if 'score_store' not in st.session_state:
+        store = ScoreStore()
+        for name, results in st.session_state.saved_sessions.items():
+            store.add_session(results, st.session_state.session_ids[name], name)
+        store.add_session(st.session_state.current_results, st.session_state.current_session_id,
+                          st.session_state.current_session_name)
+        st.session_state.score_store = store
+    return st.session_state.score_store
+
+def section_distributions(reports):
+    """Per-section summary statistics, weakest sections first."""
+    stats = reports[SECTION_SCORE_COLUMNS].describe(percentiles=[0.25, 0.5, 0.75]).T
+    stats["points lost (mean)"] = 10 - stats["mean"]
+    stats.index = [c.replace(" Score", "") for c in stats.index]
+    return stats.sort_values("mean").round(2)
+
+def common_deductions(deductions, limit=20):
+    """Most frequent deduction reasons per section, with total points lost."""
+    if deductions.empty:
+        return pd.DataFrame(columns=["Section", "Reason", "Count", "Reports", "Points Lost"])
+    grouped = deductions.groupby(["Section", "Reason"], observed=True).agg(
+        Count=("Points", "size"), Reports=("Report ID", "nunique"), **{"Points Lost": ("Points", "sum")}
+    )
+    return grouped.sort_values(["Count", "Points Lost"], ascending=False).head(limit).reset_index()
+
+def compare_sessions(reports, sessions):
+    """Mean section and total scores side by side for the chosen classes."""
+    subset = reports[reports["Session"].isin(sessions)]
+    table = subset.groupby("Session", observed=True)[SECTION_SCORE_COLUMNS + ["Total Score"]].mean().T
+    table.index = [c.replace(" Score", "") for c in table.index]
+    if len(table.columns) == 2:
+        table["Difference"] = table.iloc[:, 1] - table.iloc[:, 0]
+    return table.round(2)
+
+def model_score_drift(reports):
+    """Mean scores per model ID and how far each model sits from the all-model mean."""
+    columns = SECTION_SCORE_COLUMNS + ["Total Score"]
+    by_model = reports.groupby("Model", observed=True)[columns].mean()
+    drift = (by_model - reports[columns].mean()).add_suffix(" Drift")
+    counts = reports.groupby("Model", observed=True).size().rename("Reports")
+    return pd.concat([counts, by_model[["Total Score"]], drift], axis=1).round(2)
+
+def display_class_analytics():
+    store = get_score_store()
+    reports = store.reports()
+    if reports.empty:
+        st.info("No graded reports yet.")
+        return
+    st.caption(f"{len(reports):,} graded reports across {reports['Session'].nunique()} session(s).")
+
+    st.write("#### Section score distributions")
+    distributions = section_distributions(reports)
+    st.bar_chart(distributions["mean"])
+    st.dataframe(distributions, use_container_width=True)
+
+    st.write("#### Most common deductions")
+    st.dataframe(common_deductions(store.deductions()), use_container_width=True, hide_index=True)
+
+    sessions = list(reports["Session"].cat.categories)
+    if len(sessions) > 1:
+        st.write("#### Class vs class")
+        chosen = st.multiselect("Sessions to compare", sessions, default=sessions[-2:])
+        if chosen:
+            st.dataframe(compare_sessions(reports, chosen), use_container_width=True)
+
+    if reports["Model"].nunique() > 1:
+        st.write("#### Score drift across model IDs")
+        st.dataframe(model_score_drift(reports), use_container_width=True)
+
+# --- FEEDBACK SEARCH (SQLITE FTS5) ---
+GENERAL_SECTION = "GENERAL"  # summary, actionable steps and anything else outside the ten rubric sections
+
+class FeedbackSearchIndex:
+    """
+    On-disk full-text index of every graded report, one row per feedback section, so questions
+    like "who lost points for a missing R²?" are answered by SQLite FTS5 in milliseconds without
+    loading sessions into memory. The file is shared by the whole deployment, so every row belongs
+    to an owner (the teacher) and every query is scoped to one. Reports are upserted by
+    (owner, session ID, filename) as they are graded; the session name is only a label.
+    """
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            columns = [row[1] for row in self.conn.execute("PRAGMA table_info(reports)")]
+            if columns and "owner" not in columns:
+                # Rows from before owners existed cannot be attributed to anyone: start the index over
+                print("🔎 Rebuilding the feedback search index with per-teacher ownership.")
+                self.conn.executescript("DROP TABLE reports; DROP TABLE IF EXISTS sections; DROP TABLE IF EXISTS sections_fts;")
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS reports (
+                    id INTEGER PRIMARY KEY, owner TEXT, session_id TEXT, session TEXT, filename TEXT,
+                    score REAL, graded_at TEXT, UNIQUE (owner, session_id, filename));
+                CREATE TABLE IF NOT EXISTS sections (
+                    id INTEGER PRIMARY KEY, report_id INTEGER, section TEXT, score REAL);
+                CREATE INDEX IF NOT EXISTS sections_report ON sections (report_id);
+                CREATE INDEX IF NOT EXISTS reports_owner_session ON reports (owner, session);
+                CREATE VIRTUAL TABLE IF NOT EXISTS sections_fts USING fts5(body, tokenize = 'unicode61');
+            """)
+
+    @staticmethod
+    def split_sections(feedback):
+        """(section, score, text) for each rubric section plus the general text around them."""
+        feedback = DEDUCTION_CODES_COMMENT_RE.sub('', feedback)
+        scores = extract_section_scores(feedback)
+        spans = sorted(feedback_section_blocks(feedback).items(), key=lambda kv: kv[1][0])
+        rows, general, cursor = [], [], 0
+        for name, (start, end) in spans:
+            general.append(feedback[cursor:start])
+            score = scores[f"{name.title()} Score"]
+            rows.append((name, None if np.isnan(score) else score, feedback[start:end]))
+            cursor = end
+        general.append(feedback[cursor:])
+        rows.append((GENERAL_SECTION, None, "".join(general)))
+        return rows
+
+    def _delete(self, where, params):
+        ids = "SELECT s.id FROM sections s JOIN reports r ON r.id = s.report_id WHERE " + where
+        self.conn.execute(f"DELETE FROM sections_fts WHERE rowid IN ({ids})", params)
+        self.conn.execute(f"DELETE FROM sections WHERE id IN ({ids})", params)
+        self.conn.execute("DELETE FROM reports WHERE " + where.replace("r.", ""), params)
+
+    def _insert(self, item, owner, session_id, session):
+        try:
+            total = float(item.get('Score'))
+        except (TypeError, ValueError):
+            total = None
+        self._delete("r.owner = ? AND r.session_id = ? AND r.filename = ?", (owner, session_id, item['Filename']))
+        report_id = self.conn.execute(
+            "INSERT INTO reports (owner, session_id, session, filename, score, graded_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (owner, session_id, session, item['Filename'], total, item.get('Graded At')),
+        ).lastrowid
+        for section, score, body in self.split_sections(item['Feedback']):
+            section_id = self.conn.execute(
+                "INSERT INTO sections (report_id, section, score) VALUES (?, ?, ?)", (report_id, section, score)
+            ).lastrowid
+            self.conn.execute("INSERT INTO sections_fts (rowid, body) VALUES (?, ?)", (section_id, body))
+
+    def add(self, item, owner, session_id, session):
+        """Index one graded report (a later grade of the same file in the same session replaces it)."""
+        self.add_session([item], owner, session_id, session)
+
+    def add_session(self, results, owner, session_id, session):
+        """Index a whole session in one transaction."""
+        with self.lock, self.conn:
+            for item in results:
+                if not is_failed_grade(item):
+                    self._insert(item, owner, session_id, session)
+
+    def drop_session(self, owner, session_id):
+        with self.lock, self.conn:
+            self._delete("r.owner = ? AND r.session_id = ?", (owner, session_id))
+
+    def rename_session(self, owner, session_id, session):
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE reports SET session = ? WHERE owner = ? AND session_id = ?", (session, owner, session_id))
+
+    def sessions(self, owner):
+        with self.lock:
+            return [r[0] for r in self.conn.execute(
+                "SELECT DISTINCT session FROM reports WHERE owner = ? ORDER BY session", (owner,))]
+
+    @staticmethod
+    def match_expression(query):
+        """Plain words become an all-terms phrase search; queries already using FTS5 syntax pass through."""
+        if re.search(r'"|\*|\b(?:AND|OR|NOT|NEAR)\b', query):
+            return query
+        terms = re.findall(r"\w+", query)
+        return " ".join('"' + t.replace('"', '""') + '"' for t in terms)
+
+    def search(self, query, owner, section=None, score_range=None, sessions=None, limit=200):
+        """
+        Matching sections of `owner`'s reports, best first. `score_range` filters the section
+        score when a section is chosen, otherwise the report's total score.
+        """
+        expression = self.match_expression(query)
+        if not expression:
+            return pd.DataFrame(columns=["Session", "Filename", "Section", "Score", "Match"])
+        sql = (
+            "SELECT r.session, r.filename, s.section, COALESCE(s.score, r.score), "
+            "snippet(sections_fts, 0, '«', '»', '…', 14) "
+            "FROM sections_fts JOIN sections s ON s.id = sections_fts.rowid JOIN reports r ON r.id = s.report_id "
+            "WHERE sections_fts MATCH ? AND r.owner = ?"
+        )
+        params = [expression, owner]
+        if section:
+            sql += " AND s.section = ?"
+            params.append(section)
+        if score_range:
+            sql += f" AND {'s.score' if section else 'r.score'} BETWEEN ? AND ?"
+            params += list(score_range)
+        if sessions:
+            sql += f" AND r.session IN ({', '.join('?' * len(sessions))})"
+            params += list(sessions)
+        sql += " ORDER BY bm25(sections_fts) LIMIT ?"
+        params.append(limit)
+        with self.lock:
+            try:
+                rows = self.conn.execute(sql, params).fetchall()
+            except sqlite3.OperationalError:
+                # Malformed FTS5 syntax: retry as plain words
+                params[0] = " ".join('"' + t + '"' for t in re.findall(r"\w+", query))
+                rows = self.conn.execute(sql, params).fetchall() if params[0] else []
+        df = pd.DataFrame(rows, columns=["Session", "Filename", "Section", "Score", "Match"])
+        df["Section"] = df["Section"].str.title()
+        df["Match"] = df["Match"].str.replace(r"\s+", " ", regex=True)
+        return df
+
+@st.cache_resource
+def get_search_index():
+    """One index file for the whole deployment, shared by every session (rows are scoped by owner)."""
+    os.makedirs(AUTOSAVE_ROOT, exist_ok=True)
+    return FeedbackSearchIndex(os.path.join(AUTOSAVE_ROOT, "feedback_search.sqlite"))
+
+def search_owner():
+    """
+    Who owns this session's index rows: the signed-in teacher, else the configured TEACHER_ID.
+    Stable across reloads, so history graded in earlier tabs stays searchable.
+    """
+    try:
+        if st.user.is_logged_in and st.user.get("email"):
+            return st.user.email
+    except Exception:
+        pass
+    return TEACHER_ID
+
 def display_results_ui():
     if not st.session_state.current_results:
         return
@@ -825,14 +3192,13 @@ def display_results_ui():
     
     # --- DOWNLOADS ---
     csv_data = csv_df.to_csv(index=False).encode('utf-8-sig') 
-    master_doc_data = create_master_doc(st.session_state.current_results, st.session_state.current_session_name)
-    zip_data = create_zip_bundle(st.session_state.current_results)
+    master_doc_file, zip_file = get_cached_exports(st.session_state.current_results, st.session_state.current_session_name)
     
     col1, col2, col3 = st.columns(3)
     with col1:
-        st.download_button("📄 Docs (.docx)", master_doc_data, f'{st.session_state.current_session_name}_Docs.docx', "application/vnd.openxmlformats-officedocument.wordprocessingml.document", use_container_width=True)
+        st.download_button("📄 Docs (.docx)", lambda: read_export(master_doc_file), f'{st.session_state.current_session_name}_Docs.docx', "application/vnd.openxmlformats-officedocument.wordprocessingml.document", use_container_width=True)
     with col2:
-        st.download_button("📦 Bundle (.zip)", zip_data, f'{st.session_state.current_session_name}_Students.zip', "application/zip", use_container_width=True)
+        st.download_button("📦 Bundle (.zip)", lambda: read_export(zip_file), f'{st.session_state.current_session_name}_Students.zip', "application/zip", use_container_width=True)
     with col3:
         st.download_button("📊 CSV Export", csv_data, f'{st.session_state.current_session_name}_Detailed.csv', "text/csv", use_container_width=True)
 
@@ -842,8 +3208,18 @@ def display_results_ui():
 
     # --- MAIN DISPLAY (RENDERED ONCE) ---
     st.divider()
-    st.write("### 🏆 Gradebook")
-    st.dataframe(csv_df, use_container_width=True)
+    gradebook_tab, analytics_tab = st.tabs(["🏆 Gradebook", "📈 Class Analytics"])
+    with gradebook_tab:
+        st.dataframe(csv_df, use_container_width=True)
+    with analytics_tab:
+        display_class_analytics()
+    
+    # --- NEAR-DUPLICATE FLAGS ---
+    flagged = {id(c): c for c in st.session_state.duplicate_flags.values()}
+    if flagged:
+        with st.expander(f"🚩 Near-duplicate reports flagged for review ({len(flagged)} group(s))"):
+            for cluster in flagged.values():
+                st.markdown(f"**{cluster['similarity']:.0%} similar:** " + ", ".join(f"`{m}`" for m in cluster['members']))
     
     st.write("### 📝 Detailed Feedback History")
     # We use reversed() so the newest file is always at the top
@@ -855,7 +3231,7 @@ def display_results_ui():
 
     # --- AUTOSAVE FOLDER ACCESS ---
     st.divider()
-    st.info("💾 **Auto-saved files:** Individual feedback documents and gradebook are being saved to the `autosave_feedback_pre-ib` folder as grading progresses.")
+    st.info(f"💾 **Auto-saved files:** Individual feedback documents and gradebook are being saved to this session's folder `{os.path.relpath(st.session_state.autosave_dir)}` as grading progresses.")
     
     autosave_path = st.session_state.autosave_dir
     if os.path.exists(autosave_path):
@@ -880,13 +3256,50 @@ with st.sidebar:
         value="claude-sonnet-4-20250514", 
         help="Change this if you have a specific Beta model or newer ID"
     )
+
+    incremental_regrade = st.checkbox(
+        "♻️ Incremental regrade of resubmissions",
+        value=True,
+        help="When a student resubmits a Word report, only the sections that changed are sent for regrading."
+    )
+
+    upload_once = st.checkbox(
+        "📎 Upload PDFs & photos once (Files API)",
+        value=False,
+        help="Each file is uploaded once and referenced by ID, so retries and regrades of large scans send a small request instead of megabytes."
+    )
+
+    local_scoring = st.checkbox(
+        "🧮 Compute scores locally from deduction codes",
+        value=False,
+        help="Claude lists rubric deduction codes instead of writing out the math; section and total scores are computed here from the rubric table. Fewer output tokens and scores that always add up."
+    )
     
     st.divider()
     st.header("💾 History Manager")
     save_name = st.text_input("Session Name", placeholder="e.g. Period 3 - Kinetics")
     if st.button("💾 Save Session"):
         if st.session_state.current_results:
+            session_id = st.session_state.current_session_id
+            replaced = st.session_state.session_ids.get(save_name)
+            if replaced and replaced != session_id:
+                get_score_store().drop_session(replaced)
+                get_search_index().drop_session(search_owner(), replaced)
+            # Already saved under another name: this is a rename, not a second copy
+            for name, saved_id in list(st.session_state.session_ids.items()):
+                if saved_id == session_id:
+                    del st.session_state.session_ids[name]
+                    st.session_state.saved_sessions.pop(name, None)
             st.session_state.saved_sessions[save_name] = st.session_state.current_results
+            st.session_state.session_ids[save_name] = session_id
+            st.session_state.current_session_name = save_name
+            batch = st.session_state.active_batch
+            if batch is not None and batch.sink.session_id == session_id:
+                batch.sink.session_name = save_name  # grades still arriving carry the new name
+            get_score_store().rename_session(session_id, save_name)
+            get_search_index().rename_session(search_owner(), session_id, save_name)
+            # Upserts by session ID: indexes results that arrived before indexing, without duplicating the rest
+            get_search_index().add_session(st.session_state.current_results, search_owner(), session_id, save_name)
             st.success(f"Saved '{save_name}'!")
         else:
             st.warning("No results to save yet.")
@@ -900,18 +3313,95 @@ with st.sidebar:
             if st.button("Load"):
                 st.session_state.current_results = st.session_state.saved_sessions[selected_session]
                 st.session_state.current_session_name = selected_session
+                st.session_state.current_session_id = st.session_state.session_ids[selected_session]
                 st.rerun()
         with col2:
             if st.button("🗑️ Delete"):
                 del st.session_state.saved_sessions[selected_session]
+                session_id = st.session_state.session_ids.pop(selected_session)
+                get_score_store().drop_session(session_id)
+                get_search_index().drop_session(search_owner(), session_id)
+                if session_id == st.session_state.current_session_id:
+                    # Grades still arriving for the open session must not bring the deleted rows back
+                    st.session_state.current_session_id = uuid.uuid4().hex
+                batch = st.session_state.active_batch
+                if batch is not None and batch.sink.session_id == session_id:
+                    # The batch's workers captured the old ID at submit: move them to a new one too
+                    if batch.sink.results is st.session_state.current_results:
+                        batch.sink.session_id = st.session_state.current_session_id
+                    else:
+                        batch.sink.session_id = uuid.uuid4().hex
                 st.rerun()
 
+    st.divider()
+    st.header("🔎 Search Feedback")
+    search_query = st.text_input("Search all graded feedback", placeholder='e.g. missing R² graph')
+    search_section = st.selectbox("Section", ["All sections"] + RUBRIC_SECTIONS + [GENERAL_SECTION], format_func=str.title)
+    score_max = 100.0 if search_section == "All sections" else 10.0
+    search_scores = st.slider("Score range", 0.0, score_max, (0.0, score_max), step=0.5,
+                              help="Section score when a section is chosen, otherwise the report's total score.")
+    search_index = get_search_index()
+    if 'search_backfilled' not in st.session_state:
+        # Sessions held in this browser session from before indexing existed (upserts make this idempotent)
+        for name, results in st.session_state.saved_sessions.items():
+            search_index.add_session(results, search_owner(), st.session_state.session_ids[name], name)
+        st.session_state.search_backfilled = True
+    search_sessions = st.multiselect("Sessions", search_index.sessions(search_owner()), placeholder="All sessions")
+    if search_query.strip():
+        search_started = time.perf_counter()
+        hits = search_index.search(
+            search_query,
+            search_owner(),
+            section=None if search_section == "All sections" else search_section,
+            score_range=None if search_scores == (0.0, score_max) else search_scores,
+            sessions=search_sessions,
+        )
+        st.caption(f"{len(hits)} match(es) in {(time.perf_counter() - search_started) * 1000:.0f} ms")
+        if not hits.empty:
+            st.dataframe(hits, hide_index=True)
+
     st.divider() 
     
     with st.expander("View Grading Criteria"):
         # CHANGED FROM st.text(PRE_IB_RUBRIC) TO st.text(IB_RUBRIC)
         st.text(PRE_IB_RUBRIC)
 
+    with st.expander("🛠️ Diagnostics"):
+        st.caption("Grading request latency across all sessions on this server; requests slower than p95 get a hedged duplicate.")
+        st.dataframe(pd.DataFrame([get_latency_tracker().stats()]), hide_index=True)
+        st.caption("Per-report time to render feedback into Word, using this session's feedback (cycled to 1,000 reports).")
+        if st.button("⏱️ Benchmark Word rendering"):
+            sample_feedbacks = [item['Feedback'] for item in st.session_state.current_results]
+            if sample_feedbacks:
+                with st.spinner("Rendering 1,000 reports with each renderer..."):
+                    st.dataframe(benchmark_renderers(sample_feedbacks, n=1000), hide_index=True)
+            else:
+                st.info("Grade or load a session first.")
+
+        st.divider()
+        st.caption("🎞️ **Record & replay:** grading replies are recorded, so a saved class can be rerun through the "
+                   "scoring, CSV and Word code offline and diffed against a baseline — no API calls.")
+        if API_MODE == "replay":
+            st.info("Replay mode: grading answers from recordings only.")
+        if st.button("📌 Save current session as replay baseline"):
+            saved, skipped = save_replay_baseline(st.session_state.current_session_name, st.session_state.current_results)
+            st.success(f"Baseline '{st.session_state.current_session_name}': {saved} report(s) saved"
+                       + (f", {skipped} without a single recorded call skipped." if skipped else "."))
+        baseline_names = get_recording_store().baseline_names()
+        if baseline_names:
+            replay_name = st.selectbox("Baseline", baseline_names)
+            if st.button("▶️ Replay & diff"):
+                with st.spinner("Replaying recorded replies..."):
+                    replay_report, replay_diffs, replay_exports = run_replay(replay_name)
+                changed = (replay_report["Status"] != "same").sum() if not replay_report.empty else 0
+                st.write(f"**{changed}** of {len(replay_report)} report(s) differ from the baseline.")
+                if replay_exports["replay_ms"] is not None and replay_exports["baseline_ms"] is not None:
+                    st.caption(f"Exports: {replay_exports['baseline_ms']:.0f} ms baseline → {replay_exports['replay_ms']:.0f} ms now")
+                st.dataframe(replay_report, hide_index=True)
+                for filename, diff in replay_diffs.items():
+                    st.markdown(f"**Feedback diff:** `{filename}`")  # (expanders cannot nest inside Diagnostics)
+                    st.code(diff, language="diff")
+
 # --- 7. MAIN INTERFACE ---
 st.title("🧪 Pre-IB Lab Grader")
 st.caption(f"Current Session: **{st.session_state.current_session_name}**")
@@ -927,6 +3417,20 @@ raw_files = st.file_uploader(
 processed_files = []
 if raw_files:
     processed_files, counts = process_uploaded_files(raw_files)
+    if counts['image'] > 1:
+        with st.expander("📸 Photo submissions"):
+            st.caption("Page photos are grouped per student by zip folder, or by filename prefix when the name has a page "
+                       "marker (e.g. `smith_page1.jpg`, `smith_p2.jpg`). Camera names such as `IMG_20240912_101500.jpg` "
+                       "are never grouped by name — add `filename, student` lines to group them.")
+            group_photos = st.checkbox("Group page photos by student", value=True,
+                                       help="Turn off to grade every photo as a complete report on its own.")
+            photo_mapping = st.text_area("Photo → student mapping (optional)", placeholder="IMG_1234.jpg, Smith")
+        photos_grouped = 0
+        if group_photos:
+            processed_files, photos_grouped = group_photo_submissions(processed_files, parse_photo_mapping(photo_mapping))
+        if photos_grouped:
+            photo_students = sum(isinstance(f, PhotoSubmission) for f in processed_files)
+            st.info(f"📸 Grouped **{photos_grouped}** photos into **{photo_students}** student submission(s) — one request each.")
     if len(processed_files) > 0:
         st.success(f"✅ Found **{len(processed_files)}** valid reports.")
         st.caption(f"📄 PDFs: {counts['pdf']} | 📝 Word Docs: {counts['docx']} | 🖼️ Images: {counts['image']}")
@@ -936,81 +3440,217 @@ if raw_files:
         if raw_files:
             st.warning("No valid PDF, Word, or Image files found.")
 
-# Find the grading button section (around line 820-890) and replace with this:
+# --- PRE-FLIGHT PLAN (token counts, limits, cost & time, before any grading call) ---
+preflight = {}
+if processed_files:
+    if 'preflight_cache' not in st.session_state:
+        st.session_state.preflight_cache = {}
+    with st.spinner("Measuring reports..."):
+        plan = preflight_files(processed_files, user_model_id, local_scoring, st.session_state.preflight_cache, upload_once)
+    preflight = {row['Filename']: row for row in plan}
+    summary = preflight_summary(plan)
+    tokens_col, cost_col, eta_col = st.columns(3)
+    tokens_col.metric("Est. input tokens", f"{summary['input_tokens']:,}")
+    cost_col.metric("Est. cost", f"${summary['cost']:.2f}")
+    eta_col.metric("Est. time", f"~{max(1, round(summary['eta_seconds'] / 60))} min",
+                   help=f"At {MAX_CONCURRENT_GRADES} reports in parallel; other teachers' batches share these slots.")
+    if summary['flagged']:
+        st.warning(f"🚫 **{summary['flagged']}** report(s) exceed API limits and will not be sent — see the plan below.")
+    with st.expander("📐 Pre-flight plan (largest reports are graded first)"):
+        df_plan = pd.DataFrame(plan).sort_values("Input Tokens", ascending=False)
+        st.dataframe(df_plan[["Filename", "Size (MB)", "Input Tokens", "Counted", "Est. Cost ($)", "Issues"]],
+                     hide_index=True, use_container_width=True)
+
+# --- NEAR-DUPLICATE CHECK (runs at upload, before any API calls) ---
+DUPLICATE_MODES = {
+    "flag": "🚩 Grade every report, flag duplicates for review",
+    "share": "🔗 Grade each cluster once, share feedback with duplicates",
+    "skip": "⏭️ Grade one report per cluster, skip the rest (flag for review)",
+}
+duplicate_clusters = []
+duplicate_mode = "flag"
+if processed_files:
+    duplicate_clusters = find_near_duplicates(processed_files, st.session_state.current_session_name, search_owner())
+    if duplicate_clusters:
+        st.warning(f"🔁 Found **{len(duplicate_clusters)}** group(s) of near-duplicate reports.")
+        with st.expander("View near-duplicates"):
+            for cluster in duplicate_clusters:
+                line = f"**{cluster['similarity']:.0%} similar:** " + ", ".join(f"`{m}`" for m in cluster['members'])
+                if cluster['prior']:
+                    line += " — also matches " + ", ".join(
+                        f"`{m['label']}` ({m['session']})" if m['label'] else f"a report from another teacher ({m['similarity']:.0%})"
+                        for m in cluster['prior'][:5]
+                    )
+                st.markdown(line)
+        duplicate_mode = st.radio(
+            "Near-duplicate handling",
+            list(DUPLICATE_MODES),
+            format_func=DUPLICATE_MODES.get,
+        )
+
+_results_lock = threading.Lock()
+
+class SessionResultSink:
+    """
+    Everything a finished grade is saved into, captured from the page's session state when
+    a batch is submitted: the results list, dead-letter list, near-duplicate followers,
+    autosave folder, score store and search index. Grading workers call deliver() directly,
+    so results are kept (and backed up) whether or not the page is still open.
+    """
+    def __init__(self):
+        state = st.session_state
+        self.results = state.current_results
+        self.failed_grades = state.failed_grades
+        self.shared_feedback = state.shared_feedback
+        self.autosave_dir = state.autosave_dir
+        self.session_id = state.current_session_id
+        self.session_name = state.current_session_name  # updated if the session is saved under a new name
+        self.owner = search_owner()
+        self.score_store = get_score_store()
+        self.search_index = get_search_index()
+
+    def save(self, new_entry):
+        """Add a finished grade (replacing an earlier grade of the same file) and back it up to disk."""
+        with _results_lock:
+            previous = next((i for i, item in enumerate(self.results) if item['Filename'] == new_entry['Filename']), None)
+            if previous is None:
+                self.results.append(new_entry)
+            else:
+                self.results[previous] = new_entry
+        self.score_store.add(new_entry, self.session_id, self.session_name)
+        self.search_index.add(new_entry, self.owner, self.session_id, self.session_name)
+        return autosave_report(new_entry, self.autosave_dir)
+
+    def deliver(self, job, outcome, payload):
+        """Store one finished job. Returns (outcome, saved entry or error, autosaved) for the page."""
+        filename = job[0]
+        if outcome == "error":
+            # Failures are kept out of the results, so the resume check and exports never treat them as graded
+            failed = self.failed_grades.get(filename, {"attempts": 0})
+            self.failed_grades[filename] = {
+                "job": job,
+                "error": str(payload),
+                "transient": getattr(payload, "transient", False),
+                "attempts": failed["attempts"] + 1,
+            }
+            self.dead_letter_followers(filename, payload, getattr(payload, "transient", False))
+            return "error", payload, None
+
+        self.failed_grades.pop(filename, None)
+        feedback = payload['Feedback']
+        score = parse_score(feedback)
+        new_entry = {
+            "Filename": filename,
+            "Score": score,
+            **payload
+        }
+        autosaved = self.save(new_entry)
+
+        # Near-duplicates graded once: hand the same feedback to the rest of the cluster
+        for member, similarity, _ in self.shared_feedback.pop(filename, []):
+            self.failed_grades.pop(member, None)
+            self.save({
+                "Filename": member,
+                "Score": score,
+                "Feedback": share_feedback(feedback, filename, member, similarity)
+            })
+        return "ok", new_entry, autosaved
+
+    def dead_letter_followers(self, filename, error, transient):
+        """A cluster representative could not be graded: its near-duplicates have nothing to share, so they fail too."""
+        for member, _, job in self.shared_feedback.pop(filename, []):
+            self.failed_grades[member] = {
+                "job": job,
+                "error": f"Near-duplicate of {filename}, which was not graded: {error}",
+                "transient": transient,
+                "attempts": 0,
+                "duplicate_of": filename,
+            }
+
+def save_graded_entry(new_entry):
+    """Add a finished grade to this session (replacing an earlier grade of the same file) and back it up to disk."""
+    return SessionResultSink().save(new_entry)
+
+def share_feedback(feedback, source_name, target_name, similarity):
+    """Copy a cluster representative's feedback onto a near-duplicate report."""
+    note = (f"**⚠️ NEAR-DUPLICATE:** This report is {similarity:.0%} similar to `{source_name}`. "
+            f"Feedback below was shared from that report — please review before returning it.\n\n")
+    feedback = re.sub(r"STUDENT:.*", f"STUDENT: {target_name}", feedback, count=1)
+    return note + feedback
+
+def stream_batch_results(batch):
+    """Pull this session's finished grades off the shared scheduler as they arrive."""
+    scheduler = get_grading_scheduler()
 
-if st.button("🚀 Grade Reports", type="primary", disabled=not processed_files):
-    
     st.write("---")
-    progress = st.progress(0)
+    progress = st.progress(batch.finished / max(batch.total, 1))
     status_text = st.empty()
     live_results_table = st.empty()
     
     # NEW: Placeholder for cumulative feedback display (cleared and rewritten each iteration)
     st.subheader("📋 Live Grading Feedback")
     feedback_placeholder = st.empty()
-    
-    # Initialize Session State list if not present
-    if 'current_results' not in st.session_state:
-        st.session_state.current_results = []
-    
-    # Create a set of already graded filenames for quick lookup
-    existing_filenames = {item['Filename'] for item in st.session_state.current_results}
-    
-    for i, file in enumerate(processed_files):
-        # 1. SMART RESUME CHECK: Skip if already graded
-        if file.name in existing_filenames:
-            status_text.info(f"↩ Skipping **{file.name}** (Already Graded)")
-            time.sleep(0.5) # Brief pause for visual feedback
-            progress.progress((i + 1) / len(processed_files))
-            continue
 
-        # 2. GRADING LOGIC
-        status_text.markdown(f"**Grading:** `{file.name}` ({i+1}/{len(processed_files)})...")
-        
+    while not (batch.done and batch.results.empty()):
+        # Tells the scheduler a page is still following this batch (the script stops when the tab closes)
+        batch.last_seen = time.monotonic()
         try:
-            # Polite delay to prevent API overloading
-            time.sleep(2) 
-            
-            feedback = grade_submission(file, user_model_id)
-            score = parse_score(feedback)
-            
-            # 3. IMMEDIATE SAVE TO SESSION STATE
-            new_entry = {
-                "Filename": file.name,
-                "Score": score,
-                "Feedback": feedback
-            }
-            
-            st.session_state.current_results.append(new_entry)
-            
-            # 4. AUTOSAVE TO DISK
-            autosave_success = autosave_report(new_entry, st.session_state.autosave_dir)
+            filename, outcome, payload, autosave_success = batch.results.get(timeout=0.5)
+        except queue.Empty:
+            if batch.running == 0 and batch.pending:
+                stats = scheduler.stats()
+                status_text.info(
+                    f"⏳ Waiting for a grading slot... ({stats['running']} grading, "
+                    f"{stats['queued']} queued across {stats['users']} teacher(s))"
+                )
+            else:
+                progress.progress(batch.finished / max(batch.total, 1))
+            continue
+
+        # 3. SAVED TO SESSION STATE + 4. AUTOSAVED TO DISK by the grading worker (SessionResultSink)
+        if outcome == "error":
+            status_text.error(f"❌ Error grading {filename}: {payload}")
+        else:
+            score = payload['Score']
             if autosave_success:
-                status_text.success(f"✅ **{file.name}** graded & auto-saved! (Score: {score}/100)")
+                status_text.success(f"✅ **{filename}** graded & auto-saved! (Score: {score}/100)")
             else:
-                status_text.warning(f"⚠️ **{file.name}** graded but autosave failed (Score: {score}/100)")
+                status_text.warning(f"⚠️ **{filename}** graded but autosave failed (Score: {score}/100)")
             
-            # Update the existing set so duplicates within the same batch run are also caught
-            existing_filenames.add(file.name)
-            
-            # 5. LIVE TABLE UPDATE
-            df_live = pd.DataFrame(st.session_state.current_results)
+            # 5. LIVE TABLE UPDATE (a snapshot: workers keep appending to the batch's results list)
+            results = list(batch.sink.results)
+            df_live = pd.DataFrame(results)
             live_results_table.dataframe(df_live[["Filename", "Score"]], use_container_width=True)
             
             # 6. LIVE FEEDBACK DISPLAY (During grading only)
             with feedback_placeholder.container():
-                for idx, item in enumerate(st.session_state.current_results):
-                    is_most_recent = (idx == len(st.session_state.current_results) - 1)
+                for idx, item in enumerate(results):
+                    is_most_recent = (idx == len(results) - 1)
                     with st.expander(f"📄 {item['Filename']} (Score: {item['Score']}/100)", expanded=is_most_recent):
                         st.markdown(item['Feedback'], unsafe_allow_html=True)
-            
-        except Exception as e:
-            st.error(f"❌ Error grading {file.name}: {e}")
-            
-        progress.progress((i + 1) / len(processed_files))
+
+        progress.progress(batch.finished / max(batch.total, 1))
+
+    st.session_state.active_batch = None
+
+    # End-of-batch sweep: transient failures (overloads, timeouts) get another pass before they are dead-lettered
+    retry_jobs = [f["job"] for name, f in st.session_state.failed_grades.items()
+                  if f["transient"] and (name in batch.jobs or f.get("duplicate_of") in batch.jobs)]
+    if retry_jobs and batch.retry_round < GRADE_RETRY_SWEEPS:
+        st.session_state.active_batch = get_grading_scheduler().submit(
+            st.session_state.user_id, retry_jobs, retry_round=batch.retry_round + 1, sink=batch.sink
+        )
+        st.warning(f"🔁 Retrying **{len(retry_jobs)}** report(s) that failed with temporary errors...")
+        time.sleep(1)
+        st.rerun()
         
     # 7. CLEAR LIVE GRADING DISPLAY AFTER COMPLETION
-    status_text.success("✅ Grading Complete! All reports auto-saved.")
+    failures = [name for name, f in st.session_state.failed_grades.items()
+                if name in batch.jobs or f.get("duplicate_of") in batch.jobs]
+    if failures:
+        status_text.warning(f"⚠️ Grading finished, but **{len(failures)}** report(s) failed — see Failed Grades below.")
+    else:
+        status_text.success("✅ Grading Complete! All reports auto-saved.")
     progress.empty()
     feedback_placeholder.empty()  # ← THIS IS THE KEY FIX - Clears the live feedback
     live_results_table.empty()     # ← Also clear the live table
@@ -1018,6 +3658,122 @@ if st.button("🚀 Grade Reports", type="primary", disabled=not processed_files)
     # Show message about autosave location
     st.info(f"💾 **Backup Location:** All feedback has been saved to `{st.session_state.autosave_dir}/` folder. You can download individual files or the full gradebook below.")
 
+grading_in_progress = st.session_state.active_batch is not None
+
+if st.button("🚀 Grade Reports", type="primary", disabled=not processed_files or grading_in_progress):
+    # Create a set of already graded filenames for quick lookup
+    graded = [item for item in st.session_state.current_results if not is_failed_grade(item)]
+    existing_filenames = {item['Filename'] for item in graded}
+    graded_hashes = {item['Filename']: item.get('Content Hash') for item in graded}
+    
+    # Near-duplicates: every member after the first in a cluster is flagged, and optionally not sent
+    st.session_state.shared_feedback = defaultdict(list)
+    sink = SessionResultSink()
+    files_by_name = {file.name: file for file in processed_files}
+    not_sent = set()
+    for cluster in duplicate_clusters:
+        representative, *others = cluster['members']
+        for member in cluster['members']:
+            st.session_state.duplicate_flags[member] = cluster
+        if duplicate_mode == "share":
+            # Each follower keeps its own job, so it can be graded on its own if the representative fails
+            followers = [(m, cluster['similarity'], (m, run_grading_job, (files_by_name[m], user_model_id, None, upload_once, local_scoring)))
+                         for m in others if m not in existing_filenames]
+            graded = next((r for r in st.session_state.current_results if r['Filename'] == representative), None)
+            if graded is None:
+                st.session_state.shared_feedback[representative] += followers
+            else:
+                for member, similarity, _ in followers:
+                    save_graded_entry({
+                        "Filename": member,
+                        "Score": graded['Score'],
+                        "Feedback": share_feedback(graded['Feedback'], representative, member, similarity)
+                    })
+        if duplicate_mode in ("share", "skip"):
+            not_sent.update(others)
+
+    jobs = []
+    skipped = 0
+    resubmissions = 0
+    # Largest reports first, so the slowest requests are not left running alone at the end
+    by_size = sorted(processed_files, key=lambda f: preflight.get(f.name, {}).get("Input Tokens", 0), reverse=True)
+    for file in by_size:
+        content_hash = file_content_hash(file)
+        # 1. SMART RESUME CHECK: Skip if already graded (a changed file with the same name is a resubmission)
+        if file.name in existing_filenames and graded_hashes.get(file.name) in (None, content_hash):
+            skipped += 1
+            continue
+        if file.name in not_sent:
+            continue
+        issues = preflight.get(file.name, {}).get("Issues")
+        if issues:
+            # Would be rejected mid-batch: dead-letter it now instead of spending a request
+            st.session_state.failed_grades[file.name] = {
+                "job": (file.name, run_grading_job, (file, user_model_id, None, upload_once, local_scoring)),
+                "error": f"Pre-flight: {issues}", "transient": False, "attempts": 0, "preflight": True,
+            }
+            sink.dead_letter_followers(file.name, f"Pre-flight: {issues}", False)
+            continue
+        # Update the existing set so duplicates within the same batch run are also caught
+        existing_filenames.add(file.name)
+        graded_hashes[file.name] = content_hash
+
+        prior = None
+        if incremental_regrade and file.name.lower().endswith('.docx'):
+            prior = find_prior_submission(file.name, content_hash)
+            resubmissions += prior is not None
+
+        # 2. QUEUE ON THE SHARED SCHEDULER (grading runs in the background worker pool)
+        jobs.append((file.name, run_grading_job, (file, user_model_id, prior, upload_once, local_scoring)))
+
+    if skipped:
+        st.info(f"↩ Skipping **{skipped}** report(s) (Already Graded)")
+    if resubmissions:
+        st.info(f"♻️ **{resubmissions}** resubmission(s) found — only their changed sections will be regraded.")
+    if jobs:
+        st.session_state.active_batch = get_grading_scheduler().submit(st.session_state.user_id, jobs, sink=sink)
+
+# The batch keeps grading across reruns; resume streaming its results into this session
+if st.session_state.active_batch is not None:
+    if st.button("⏹️ Stop Grading"):
+        get_grading_scheduler().cancel(st.session_state.active_batch)
+        st.warning("Stopping... reports already being graded will still be saved.")
+    stream_batch_results(st.session_state.active_batch)
+
+# --- DEAD-LETTER LIST: reports that could not be graded, retryable without re-uploading ---
+if st.session_state.failed_grades and st.session_state.active_batch is None:
+    failed_grades = st.session_state.failed_grades
+    with st.expander(f"❌ Failed Grades ({len(failed_grades)})", expanded=True):
+        st.dataframe(pd.DataFrame([
+            {"Filename": name, "Error": f["error"], "Kind": "Temporary" if f["transient"] else "Permanent",
+             "Attempts": f["attempts"]}
+            for name, f in failed_grades.items()
+        ]), hide_index=True, use_container_width=True)
+        retry_col, clear_col = st.columns(2)
+        if retry_col.button(f"🔁 Retry all {len(failed_grades)} failed", type="primary"):
+            # Pre-flight rejections would fail the same way: measure them again with the current settings first
+            rejected = {name: f for name, f in failed_grades.items() if f.get("preflight")}
+            still_rejected = set()
+            if rejected:
+                files = [f["job"][2][0] for f in rejected.values()]
+                for row in preflight_files(files, user_model_id, local_scoring,
+                                           st.session_state.setdefault('preflight_cache', {}), upload_once):
+                    entry = rejected[row["Filename"]]
+                    entry["job"] = (row["Filename"], run_grading_job, (entry["job"][2][0], user_model_id, None, upload_once, local_scoring))
+                    if row["Issues"]:
+                        entry["error"] = f"Pre-flight: {row['Issues']}"
+                        still_rejected.add(row["Filename"])
+            jobs = [f["job"] for name, f in failed_grades.items() if name not in still_rejected]
+            if jobs:
+                st.session_state.active_batch = get_grading_scheduler().submit(
+                    st.session_state.user_id, jobs, retry_round=GRADE_RETRY_SWEEPS, sink=SessionResultSink()
+                )
+            st.rerun()
+        if clear_col.button("🗑️ Dismiss failures"):
+            # Cleared in place: a running batch's workers hold this same dict
+            st.session_state.failed_grades.clear()
+            st.rerun()
+
 # --- 8. PERSISTENT DISPLAY (This stays - it's called outside the grading loop) ---
 if st.session_state.current_results:
     display_results_ui()
\ No newline at end of file